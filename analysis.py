@@ -0,0 +1,71 @@
+'''
+Text analysis shared by index.py and search.py, so that documents and queries are normalized identically
+
+Text is split into tokens by a tokenizer, and every token is stemmed with the porter stemming algorithm.
+    nltk:  nltk.word_tokenize (default)
+    regex: a single regular expression, much faster than nltk.word_tokenize, which keeps words,
+           numbers and words joined by . , ' or - together, and splits off every other symbol
+Natural text follows Zipf's law, so the stems of the most frequent tokens are memoized in a bounded LRU cache.
+The tokenizer of an index is recorded next to its dictionary (dictionary-file.tokenizer),
+so that search.py always analyzes queries with the tokenizer the index was built with.
+'''
+import os
+import re
+
+from functools import lru_cache
+
+import nltk
+
+TOKENIZERS = ('nltk', 'regex')
+STEM_CACHE_SIZE = 2**16             # number of memoized stems
+TOKEN_PATTERN = re.compile(r"\w+(?:[.,'-]\w+)*|[^\w\s]")
+
+
+class Analyzer:
+    '''
+    Tokenizes and stems text, memoizing the stems of up to cache_size distinct tokens
+    '''
+    def __init__(self, tokenizer='nltk', cache_size=STEM_CACHE_SIZE):
+        '''
+        Constructor
+        '''
+        self.tokenizer = tokenizer
+        self.split = TOKEN_PATTERN.findall if tokenizer == 'regex' else nltk.word_tokenize
+        self.stem = lru_cache(maxsize=cache_size)(nltk.stem.porter.PorterStemmer().stem)
+
+    def analyze(self, line):
+        '''
+        return the stemmed tokens of a line
+        '''
+        tokenized = self.split(line)
+        # UNCOMMENT THIS IF PUNCTUATION REMOVAL IS DESIRED
+        # pattern = r'[!"#$%&\'()*+,\-./:;<=>?@[\\\]^_`{|}~]+'
+        # tokenized = filter(lambda x: not re.fullmatch(pattern, x), tokenized)
+        return [self.stem(token) for token in tokenized]
+
+    def __str__(self):
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        hit_rate = info.hits / lookups if lookups else 0
+        return (f"stem cache ({self.tokenizer} tokenizer): {info.hits} hits, {info.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{info.currsize} of {info.maxsize} stems")
+
+
+def tokenizer_file(dict_file):
+    return f"{dict_file}.tokenizer"
+
+def write_tokenizer(dict_file, tokenizer):
+    '''
+    record the tokenizer an index is built with
+    '''
+    with open(tokenizer_file(dict_file), "w") as file:
+        file.write(tokenizer + "\n")
+
+def read_tokenizer(dict_file):
+    '''
+    return the tokenizer an index was built with, nltk for indexes that did not record it
+    '''
+    if not os.path.exists(tokenizer_file(dict_file)):
+        return 'nltk'
+    with open(tokenizer_file(dict_file), "r") as file:
+        return file.read().strip()
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+import getopt
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from itertools import accumulate
+
+from corpus import read_documents
+from search import Searcher
+from shards import list_shards
+
+QUERY_MIXES = ('and', 'or', 'not', 'mixed')
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i directory-or-archive-or-jsonl-file-of-documents -o output-file-of-benchmark-results"
+          " -g number-of-documents (optional, generate a Zipfian corpus in directory-of-documents first)"
+          " -w words-per-document (optional, default 100) -V vocabulary-size (optional, default 50000)"
+          " -q file-of-queries (optional, default queries.txt) -n generated-queries-per-mix (optional, default 1000)"
+          " -x \"index.py flags\" (optional) -s seed (optional, default 0) -S (optional flag to skip indexing)")
+
+def vocabulary(size):
+    '''
+    return size distinct synthetic words, made of letters only so that every word is a single token
+    '''
+    words = []
+    for rank in range(size):
+        word = ""
+        rank += 1
+        while rank:
+            rank, letter = divmod(rank - 1, 26)
+            word = chr(ord('a') + letter) + word
+        words.append(word)
+    return words
+
+def zipf_cum_weights(size, exponent=1.0):
+    '''
+    cumulative weights of ranks 1..size under Zipf's law, the frequency of rank r being proportional to 1 / r**exponent
+    '''
+    return list(accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+def generate_corpus(out_dir, num_docs, words_per_doc=100, vocabulary_size=50000, seed=0):
+    '''
+    Write num_docs synthetic documents to out_dir, one file per docID as construct_blocks expects.
+    Words are drawn from a Zipfian distribution over the vocabulary, and document lengths
+    are drawn uniformly between half and one and a half times words_per_doc
+    '''
+    rng = random.Random(seed)
+    words = vocabulary(vocabulary_size)
+    cum_weights = zipf_cum_weights(vocabulary_size)
+    os.makedirs(out_dir, exist_ok=True)
+    for doc_id in range(1, num_docs + 1):
+        length = rng.randint(words_per_doc // 2, words_per_doc * 3 // 2)
+        doc_words = rng.choices(words, cum_weights=cum_weights, k=length)
+        # documents are read line by line, so they are written as lines of 12 words
+        with open(f"{out_dir}/{doc_id}", "w") as doc:
+            doc.writelines(" ".join(doc_words[start:start + 12]) + "\n" for start in range(0, length, 12))
+
+def generate_queries(mix, num_queries, vocabulary_size=50000, seed=0):
+    '''
+    Generate num_queries queries of the given mix, with Zipfian terms:
+        and:   a AND b
+        or:    a OR b
+        not:   a AND NOT b
+        mixed: 2 to 5 terms joined by random operators, with parentheses and NOT
+    '''
+    rng = random.Random(f"{seed}-{mix}")
+    words = vocabulary(vocabulary_size)
+    cum_weights = zipf_cum_weights(vocabulary_size)
+    term = lambda: rng.choices(words, cum_weights=cum_weights)[0]
+
+    def mixed(num_terms):
+        if num_terms == 1:
+            return ("NOT " if rng.random() < 0.2 else "") + term()
+        left = rng.randint(1, num_terms - 1)
+        return f"({mixed(left)} {rng.choice(['AND', 'OR'])} {mixed(num_terms - left)})"
+
+    queries = []
+    for _ in range(num_queries):
+        if mix == 'and':
+            queries.append(f"{term()} AND {term()}")
+        elif mix == 'or':
+            queries.append(f"{term()} OR {term()}")
+        elif mix == 'not':
+            queries.append(f"{term()} AND NOT {term()}")
+        else:
+            queries.append(mixed(rng.randint(2, 5)))
+    return queries
+
+def corpus_size(in_dir):
+    '''
+    return the number of documents and bytes of text of a directory, archive or JSONL file of documents
+    '''
+    if os.path.isdir(in_dir):
+        return len(os.listdir(in_dir)), sum(os.path.getsize(f"{in_dir}/{file}") for file in os.listdir(in_dir))
+    num_docs = 0
+    num_bytes = 0
+    for _, text in read_documents(in_dir):
+        num_docs += 1
+        num_bytes += len(text.encode("utf-8"))
+    return num_docs, num_bytes
+
+def benchmark_index(in_dir, out_dict, out_postings, index_flags=""):
+    '''
+    run index.py in a child process on in_dir, and return its throughput and peak memory
+    '''
+    num_docs, num_bytes = corpus_size(in_dir)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.py"),
+               "-i", in_dir, "-d", out_dict, "-p", out_postings] + index_flags.split()
+    start_time = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start_time
+    # the peak RSS of the largest child process, which includes the worker processes of index.py
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss          # in KB on Linux
+    shards = list_shards(out_dict, out_postings)
+    return {
+        "flags": index_flags,
+        "documents": num_docs,
+        "corpus_mb": round(num_bytes / 2**20, 3),
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(num_docs / seconds, 3),
+        "mb_per_second": round(num_bytes / 2**20 / seconds, 3),
+        "peak_rss_mb": round(peak_rss / 2**10, 3),
+        "shards": len(shards),
+        "dictionary_mb": round(sum(os.path.getsize(shard_dict) for shard_dict, _ in shards) / 2**20, 3),
+        "postings_mb": round(sum(os.path.getsize(shard_postings) for _, shard_postings in shards) / 2**20, 3),
+    }
+
+def benchmark_queries(searcher, queries):
+    '''
+    replay the queries through the Searcher used by run_search, and return their latency percentiles and throughput
+    '''
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        searcher.search(query)
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+    total = sum(latencies)
+    percentile = lambda p: round(latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000, 3) if latencies else 0.0
+    return {
+        "queries": len(queries),
+        "seconds": round(total, 3),
+        "queries_per_second": round(len(queries) / total, 3) if total else 0.0,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def run_benchmark(in_dir, results_file, queries_file, num_queries=1000, vocabulary_size=50000, index_flags="",
+                  seed=0, skip_index=False):
+    '''
+    index in_dir, replay queries_file and every generated query mix,
+    and write the results as JSON to results_file
+    '''
+    results = {"commit": current_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "corpus": in_dir}
+    out_dict = f"{in_dir.rstrip('/')}.dictionary"
+    out_postings = f"{in_dir.rstrip('/')}.postings"
+    if not skip_index:
+        print('benchmarking indexing...')
+        results["index"] = benchmark_index(in_dir, out_dict, out_postings, index_flags)
+
+    print('benchmarking queries...')
+    start_time = time.perf_counter()
+    searcher = Searcher(out_dict, out_postings)
+    results["search_startup_seconds"] = round(time.perf_counter() - start_time, 3)
+    results["queries"] = {}
+    if queries_file:
+        with open(queries_file) as file:
+            results["queries"][os.path.basename(queries_file)] = benchmark_queries(searcher, list(file))
+    for mix in QUERY_MIXES:
+        results["queries"][mix] = benchmark_queries(searcher, generate_queries(mix, num_queries, vocabulary_size, seed))
+    results["search_peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 3)
+    results["postings_cache"] = str(searcher.index.postings_cache)
+    results["result_cache"] = str(searcher.index.result_cache)
+    results["stem_cache"] = str(searcher.analyzer)
+    searcher.close()
+
+    with open(results_file, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    input_directory = None
+    output_file = None
+    num_generated_docs = None
+    words_per_doc = 100
+    vocabulary_size = 50000
+    file_of_queries = "queries.txt"
+    num_queries = 1000
+    index_flags = ""
+    seed = 0
+    skip_index = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:o:g:w:V:q:n:x:s:S')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':
+            input_directory = a
+        elif o == '-o':
+            output_file = a
+        elif o == '-g':
+            num_generated_docs = int(a)
+        elif o == '-w':
+            words_per_doc = int(a)
+        elif o == '-V':
+            vocabulary_size = int(a)
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-n':
+            num_queries = int(a)
+        elif o == '-x':
+            index_flags = a
+        elif o == '-s':
+            seed = int(a)
+        elif o == '-S':
+            skip_index = True
+        else:
+            assert False, "unhandled option"
+
+    if input_directory == None or output_file == None:
+        usage()
+        sys.exit(2)
+
+    if num_generated_docs is not None:
+        print('generating corpus...')
+        generate_corpus(input_directory, num_generated_docs, words_per_doc, vocabulary_size, seed)
+    run_benchmark(input_directory, output_file, file_of_queries, num_queries, vocabulary_size, index_flags, seed, skip_index)
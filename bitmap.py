@@ -0,0 +1,163 @@
+'''
+Compressed bitmap representation of dense postings lists
+
+On disk, a bitmap is split into roaring-style containers of 65536 docIDs each.
+Every container is written as its key (docID >> 16) and its cardinality, both
+variable byte encoded, followed by either
+    - an array container: the variable byte encoded gaps between the low 16 bits of its docIDs, or
+    - a bitmap container: 8192 bytes, one bit per docID, when it holds more than ARRAY_CONTAINER_MAX docIDs
+In memory, a Bitmap is a single python int with bit i set when docID i is in the postings list,
+so that AND, OR and NOT are single big integer operations.
+'''
+import sys
+
+from postings import encode_vbyte
+
+CONTAINER_BITS = 16
+CONTAINER_SIZE = 1 << CONTAINER_BITS                # docIDs per container
+CONTAINER_BYTES = CONTAINER_SIZE // 8               # bytes of a bitmap container
+ARRAY_CONTAINER_MAX = 4096                          # above this cardinality, a bitmap container is smaller
+
+# position of every set bit of every byte value, used to iterate over a bitmap a byte at a time
+BYTE_BITS = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+
+# number of set bits of an int, without building its binary string where int.bit_count exists (python 3.10+)
+if sys.version_info >= (3, 10):
+    popcount = int.bit_count
+else:
+    def popcount(bits):
+        return bin(bits).count("1")
+
+
+class Bitmap:
+    '''
+    Set of docIDs stored as the bits of a python int
+    '''
+    def __init__(self, bits=0):
+        '''
+        Constructor
+        '''
+        self.bits = bits
+        self._bytes = None          # little endian bytes of bits, built on the first membership test
+
+    @classmethod
+    def from_docIDs(cls, doc_ids):
+        '''
+        build a Bitmap from a sorted list of docIDs
+        '''
+        if not doc_ids:
+            return cls()
+        buffer = bytearray((doc_ids[-1] >> 3) + 1)
+        for doc_id in doc_ids:
+            buffer[doc_id >> 3] |= 1 << (doc_id & 7)
+        return cls(int.from_bytes(buffer, 'little'))
+
+    def to_bytes(self):
+        '''
+        return the bits of the bitmap as little endian bytes
+        '''
+        if self._bytes is None:
+            self._bytes = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        return self._bytes
+
+    def __contains__(self, doc_id):
+        bitmap_bytes = self.to_bytes()
+        return (doc_id >> 3) < len(bitmap_bytes) and bitmap_bytes[doc_id >> 3] >> (doc_id & 7) & 1 == 1
+
+    def __iter__(self):
+        '''
+        yield the docIDs of the bitmap in increasing order
+        '''
+        for byte_index, value in enumerate(self.to_bytes()):
+            if value:
+                base = byte_index << 3
+                for bit in BYTE_BITS[value]:
+                    yield base + bit
+
+    def __len__(self):
+        return popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __sizeof__(self):
+        # counts the bits twice, since a bitmap used in membership tests also keeps them as bytes
+        return object.__sizeof__(self) + 2 * sys.getsizeof(self.bits)
+
+
+def encode_bitmap(doc_ids):
+    '''
+    Encode a sorted list of docIDs as roaring-style containers
+    '''
+    encoded = bytearray()
+    start = 0
+    while start < len(doc_ids):
+        # collect the docIDs that share the same container key
+        key = doc_ids[start] >> CONTAINER_BITS
+        end = start
+        while end < len(doc_ids) and doc_ids[end] >> CONTAINER_BITS == key:
+            end += 1
+        lows = [doc_id & (CONTAINER_SIZE - 1) for doc_id in doc_ids[start:end]]
+
+        encoded += encode_vbyte(key) + encode_vbyte(len(lows))
+        if len(lows) > ARRAY_CONTAINER_MAX:
+            container = bytearray(CONTAINER_BYTES)
+            for low in lows:
+                container[low >> 3] |= 1 << (low & 7)
+            encoded += container
+        else:
+            previous = 0
+            for low in lows:
+                encoded += encode_vbyte(low - previous)
+                previous = low
+        start = end
+    return bytes(encoded)
+
+def decode_bitmap(data):
+    '''
+    Decode roaring-style containers into a Bitmap
+    '''
+    containers = []
+    position = 0
+    while position < len(data):
+        numbers = []
+        number = 0
+        # the container key and cardinality are the first two variable byte encoded numbers
+        while len(numbers) < 2:
+            byte = data[position]
+            position += 1
+            if byte < 128:
+                number = (number << 7) | byte
+            else:
+                numbers.append((number << 7) | (byte & 0x7f))
+                number = 0
+        key, cardinality = numbers
+
+        if cardinality > ARRAY_CONTAINER_MAX:
+            containers.append((key, data[position:position + CONTAINER_BYTES]))
+            position += CONTAINER_BYTES
+        else:
+            lows = []
+            low = 0
+            while len(lows) < cardinality:
+                byte = data[position]
+                position += 1
+                if byte < 128:
+                    number = (number << 7) | byte
+                else:
+                    low += (number << 7) | (byte & 0x7f)
+                    lows.append(low)
+                    number = 0
+            containers.append((key, lows))
+
+    if not containers:
+        return Bitmap()
+    buffer = bytearray((containers[-1][0] + 1) * CONTAINER_BYTES)
+    for key, container in containers:
+        offset = key * CONTAINER_BYTES
+        if isinstance(container, list):
+            for low in container:
+                buffer[offset + (low >> 3)] |= 1 << (low & 7)
+        else:
+            buffer[offset:offset + CONTAINER_BYTES] = container
+    return Bitmap(int.from_bytes(buffer, 'little'))
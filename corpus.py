@@ -0,0 +1,101 @@
+'''
+Sources of the documents indexed by index.py, read as a stream of (docID, text) documents in a single pass
+
+directory: one file per document, named by its docID (the Reuters layout), read in increasing docID order
+tar:       a tar archive, optionally compressed (.tar.gz, .tar.bz2, .tar.xz), of files named by their docID,
+           streamed member by member in archive order without seeking
+zip:       a zip archive of files named by their docID, read in the order the files are stored
+jsonl:     a file of one JSON object per line, {"id": docID, "text": "..."}
+Archives and JSONL files are read sequentially through buffers of READ_BUFFER_SIZE bytes,
+so a corpus of millions of small documents costs neither a directory listing nor an open per document.
+Their documents do not need to be in increasing docID order (see index.py).
+'''
+import json
+import os
+import tarfile
+import zipfile
+
+READ_BUFFER_SIZE = 2**20        # bytes read from an archive or JSONL file at a time
+CORPUS_FORMATS = ('directory', 'tar', 'zip', 'jsonl')
+
+
+def corpus_format(source):
+    '''
+    return the format of a document source from its contents, see CORPUS_FORMATS
+    '''
+    if os.path.isdir(source):
+        return 'directory'
+    if zipfile.is_zipfile(source):
+        return 'zip'
+    if tarfile.is_tarfile(source):
+        return 'tar'
+    return 'jsonl'
+
+def read_documents(source, indexed=frozenset()):
+    '''
+    stream the (docID, text) documents of a directory, archive or JSONL file, except the docIDs already indexed
+    '''
+    read = {'directory': read_directory, 'tar': read_tar, 'zip': read_zip, 'jsonl': read_jsonl}[corpus_format(source)]
+    return read(source, indexed)
+
+def member_doc_id(name):
+    '''
+    return the docID of an archive member from its file name, e.g. training/42 -> 42
+    '''
+    return int(os.path.basename(name.rstrip("/")))
+
+def read_directory(in_dir, indexed=frozenset()):
+    file_list = [f for f in os.listdir(in_dir) if int(f) not in indexed]   # obtain list of document names
+    file_list.sort(key=lambda f: int(f))            # sort document names in algebraically increasing order
+    for file in file_list:
+        with open(f"{in_dir}/{file}", "r") as doc:
+            yield int(file), doc.read()
+
+def read_tar(archive, indexed=frozenset()):
+    # the archive is read as a stream, so every member must be read before the next one.
+    # tarfile slices its own buffer on every read, so the buffering is left to the file
+    with open(archive, "rb", buffering=READ_BUFFER_SIZE) as file, tarfile.open(fileobj=file, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            doc_id = member_doc_id(member.name)
+            if doc_id in indexed:
+                continue
+            yield doc_id, tar.extractfile(member).read().decode("utf-8", errors="replace")
+
+def read_zip(archive, indexed=frozenset()):
+    with open(archive, "rb", buffering=READ_BUFFER_SIZE) as file, zipfile.ZipFile(file) as zip_file:
+        # members are read in the order they are stored, so that the archive is read sequentially
+        for member in sorted(zip_file.infolist(), key=lambda member: member.header_offset):
+            if member.is_dir():
+                continue
+            doc_id = member_doc_id(member.filename)
+            if doc_id in indexed:
+                continue
+            yield doc_id, zip_file.read(member).decode("utf-8", errors="replace")
+
+def read_jsonl(jsonl_file, indexed=frozenset()):
+    with open(jsonl_file, "rb", buffering=READ_BUFFER_SIZE) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            doc_id = int(document["id"])
+            if doc_id not in indexed:
+                yield doc_id, document["text"]
+
+def batch_documents(documents, batch_bytes):
+    '''
+    group a stream of documents into lists of documents of about batch_bytes characters of text
+    '''
+    batch = []
+    size = 0
+    for doc_id, text in documents:
+        batch.append((doc_id, text))
+        size += len(text)
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
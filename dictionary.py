@@ -0,0 +1,316 @@
+'''
+On-disk dictionary formats shared by index.py and search.py
+
+text:   the first line lists all docIDs, then every line is "term doc_freq pointer num_bytes representation".
+        Dictionaries written before bitmaps have no representation column, and all their terms are lists ("l")
+binary: a memory-mapped file that is searched in place instead of being loaded, made of
+        - a header (HEADER) with the number of terms, term blocks and the offsets of the sections below
+        - the universe: all docIDs as a compressed bitmap (see bitmap.py)
+        - the terms in sorted order, in blocks of BLOCK_SIZE terms. The first term of a block is stored whole,
+          every other term is front coded as the length of the prefix it shares with the previous term
+          and its remaining suffix, e.g. comput, computer, computers -> comput, (6, er), (8, s)
+        - the block index: the byte offset of every term block
+        - the records: (doc_freq, pointer, num_bytes, representation) of every term, in term order, in RECORD bytes each
+        A term is looked up with a binary search over the first terms of the blocks, then a scan of a single block.
+'''
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from array import array
+
+from bitmap import Bitmap, decode_bitmap, encode_bitmap
+from postings import encode_vbyte
+
+DICTIONARY_MAGIC = b'BRD1'
+DICTIONARY_FORMATS = ('binary', 'text')
+BLOCK_SIZE = 16
+# magic, block size, number of terms, number of blocks, universe offset and length, block index offset, records offset
+HEADER = struct.Struct('<4sIIIQQQQ')
+# doc_freq, pointer, num_bytes, representation
+RECORD = struct.Struct('<IQIc')
+
+
+def read_vbyte(data, position):
+    '''
+    decode the variable byte encoded number starting at position, return it with the position after it
+    '''
+    number = 0
+    while True:
+        byte = data[position]
+        position += 1
+        if byte < 128:
+            number = (number << 7) | byte
+        else:
+            return (number << 7) | (byte & 0x7f), position
+
+
+class TextDictionaryWriter:
+    '''
+    Writes the dictionary entries of an index, in alphabetical order, in the text format
+    '''
+    def __init__(self, dict_file, doc_ids, buffer_size=-1):
+        '''
+        Constructor
+        '''
+        self.file = open(dict_file, "w", buffering=buffer_size)
+        self.file.write(" ".join(map(str, doc_ids)) + "\n")
+
+    def add(self, term, doc_freq, pointer, num_bytes, representation):
+        self.file.write(f"{term} {doc_freq} {pointer} {num_bytes} {representation}\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BinaryDictionaryWriter(TextDictionaryWriter):
+    '''
+    Writes the dictionary entries of an index, in alphabetical order, in the binary format.
+    The term blocks are streamed to the file and the records to a temporary file,
+    which is appended with the block index once all terms are written
+    '''
+    def __init__(self, dict_file, doc_ids, buffer_size=-1):
+        '''
+        Constructor
+        '''
+        self.file = open(dict_file, "wb", buffering=buffer_size)
+        self.records = tempfile.TemporaryFile(buffering=buffer_size)
+        self.block_offsets = array('Q')
+        self.num_terms = 0
+        self.previous = b''
+
+        universe = encode_bitmap(doc_ids)
+        self.universe_length = len(universe)
+        self.file.write(bytes(HEADER.size))         # the header is written once all offsets are known
+        self.file.write(universe)
+        self.offset = HEADER.size + len(universe)
+
+    def add(self, term, doc_freq, pointer, num_bytes, representation):
+        encoded_term = term.encode('utf-8')
+        if self.num_terms % BLOCK_SIZE == 0:
+            self.block_offsets.append(self.offset)
+            entry = encode_vbyte(len(encoded_term)) + encoded_term
+        else:
+            prefix = os.path.commonprefix([self.previous, encoded_term])
+            entry = encode_vbyte(len(prefix)) + encode_vbyte(len(encoded_term) - len(prefix)) + encoded_term[len(prefix):]
+        self.file.write(entry)
+        self.offset += len(entry)
+        self.records.write(RECORD.pack(doc_freq, pointer, num_bytes, representation.encode('ascii')))
+        self.previous = encoded_term
+        self.num_terms += 1
+
+    def close(self):
+        block_index_offset = self.offset
+        self.file.write(self.block_offsets.tobytes())
+        records_offset = block_index_offset + len(self.block_offsets) * self.block_offsets.itemsize
+        self.records.seek(0)
+        shutil.copyfileobj(self.records, self.file)
+        self.records.close()
+        self.file.seek(0)
+        self.file.write(HEADER.pack(DICTIONARY_MAGIC, BLOCK_SIZE, self.num_terms, len(self.block_offsets),
+                                    HEADER.size, self.universe_length, block_index_offset, records_offset))
+        self.file.close()
+
+
+class BinaryDictionary:
+    '''
+    Read-only mapping of term -> [pointer, num_bytes, doc_freq, is_bitmap] over a memory-mapped
+    binary dictionary, the same entries as a loaded text dictionary. Opening it only reads the header,
+    and every lookup decodes the few term blocks it visits straight from the mapped file.
+    '''
+    def __init__(self, dict_file):
+        '''
+        Constructor
+        '''
+        self.file = open(dict_file, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+        (_, self.block_size, self.num_terms, num_blocks, self.universe_offset, self.universe_length,
+         block_index_offset, self.records_offset) = HEADER.unpack_from(self.view)
+        self.block_offsets = self.view[block_index_offset:block_index_offset + num_blocks * 8].cast('Q')
+
+    def universe(self):
+        '''
+        return the Bitmap of all docIDs of the index
+        '''
+        return decode_bitmap(self.view[self.universe_offset:self.universe_offset + self.universe_length])
+
+    def first_term(self, block):
+        length, position = read_vbyte(self.view, self.block_offsets[block])
+        return bytes(self.view[position:position + length])
+
+    def find(self, term):
+        '''
+        return the index of the record of term, or -1 if the term is not in the dictionary
+        '''
+        key = term.encode('utf-8')
+        # binary search for the last block whose first term is not after the term
+        low, high = 0, len(self.block_offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.first_term(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        block = low - 1
+        if block < 0:
+            return -1
+        # scan the front coded terms of the block
+        for term_index, encoded_term in self.block_terms(block):
+            if encoded_term == key:
+                return term_index
+            if encoded_term > key:
+                break
+        return -1
+
+    def block_terms(self, block):
+        '''
+        yield the (index, encoded term) of every term of a block
+        '''
+        position = self.block_offsets[block]
+        length, position = read_vbyte(self.view, position)
+        encoded_term = bytes(self.view[position:position + length])
+        position += length
+        first = block * self.block_size
+        yield first, encoded_term
+        for term_index in range(first + 1, min(first + self.block_size, self.num_terms)):
+            prefix_length, position = read_vbyte(self.view, position)
+            suffix_length, position = read_vbyte(self.view, position)
+            encoded_term = encoded_term[:prefix_length] + self.view[position:position + suffix_length]
+            position += suffix_length
+            yield term_index, encoded_term
+
+    def record(self, term_index):
+        doc_freq, pointer, num_bytes, representation = RECORD.unpack_from(self.view, self.records_offset + term_index * RECORD.size)
+        return doc_freq, pointer, num_bytes, representation.decode('ascii')
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def get(self, term, default=None):
+        term_index = self.find(term)
+        if term_index < 0:
+            return default
+        doc_freq, pointer, num_bytes, representation = self.record(term_index)
+        return [pointer, num_bytes, doc_freq, representation == "b"]
+
+    def __getitem__(self, term):
+        entry = self.get(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry
+
+    def __len__(self):
+        return self.num_terms
+
+    def terms(self):
+        '''
+        return the terms of the dictionary as a sorted term array (see SortedTerms)
+        '''
+        return SortedTerms(self)
+
+    def entries(self):
+        '''
+        yield the (term, doc_freq, pointer, num_bytes, representation) of every term in alphabetical order
+        '''
+        for block in range(len(self.block_offsets)):
+            for term_index, encoded_term in self.block_terms(block):
+                yield (encoded_term.decode('utf-8'),) + self.record(term_index)
+
+    def close(self):
+        self.block_offsets.release()
+        self.view.release()
+        self.buffer.close()
+        self.file.close()
+
+
+class SortedTerms:
+    '''
+    Read-only sequence of the terms of a BinaryDictionary in alphabetical order, which can be binary searched
+    with bisect like a sorted list of terms. Indexing a term decodes its term block, and the last decoded
+    block is kept, so that reading consecutive terms decodes every block once
+    '''
+    def __init__(self, dictionary):
+        '''
+        Constructor
+        '''
+        self.dictionary = dictionary
+        self.decoded = (-1, [])         # the last decoded block and its terms
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def __getitem__(self, term_index):
+        if term_index < 0:
+            term_index += len(self)
+        if not 0 <= term_index < len(self):
+            raise IndexError(term_index)
+        block = term_index // self.dictionary.block_size
+        decoded_block, terms = self.decoded
+        if decoded_block != block:
+            terms = [encoded_term.decode('utf-8') for _, encoded_term in self.dictionary.block_terms(block)]
+            self.decoded = (block, terms)
+        return terms[term_index % self.dictionary.block_size]
+
+
+def is_binary_dictionary(dict_file):
+    with open(dict_file, 'rb') as file:
+        return file.read(len(DICTIONARY_MAGIC)) == DICTIONARY_MAGIC
+
+def parse_text_entry(line):
+    '''
+    return the (term, doc_freq, pointer, num_bytes, representation) of a line of a text dictionary
+    '''
+    term, doc_freq, pointer, num_bytes, *representation = line.split()
+    return term, int(doc_freq), int(pointer), int(num_bytes), representation[0] if representation else "l"
+
+def load_dictionary(dict_file):
+    '''
+    return the Bitmap of all docIDs of a dictionary file and its mapping of term -> [pointer, num_bytes, doc_freq, is_bitmap].
+    A binary dictionary is memory-mapped, a text dictionary is loaded into a dict
+    '''
+    if is_binary_dictionary(dict_file):
+        dictionary = BinaryDictionary(dict_file)
+        return dictionary.universe(), dictionary
+    dictionary = {}
+    with open(dict_file, 'r') as dic_file:
+        # first line in dict_file contains all docIDs
+        universe = Bitmap.from_docIDs([int(x) for x in dic_file.readline().split()])
+        for line in dic_file:
+            term, doc_freq, pointer, num_bytes, representation = parse_text_entry(line)
+            dictionary[term] = [pointer, num_bytes, doc_freq, representation == "b"]
+    return universe, dictionary
+
+def read_universe(dict_file):
+    '''
+    return the Bitmap of all docIDs of a dictionary file
+    '''
+    if is_binary_dictionary(dict_file):
+        dictionary = BinaryDictionary(dict_file)
+        universe = dictionary.universe()
+        dictionary.close()
+        return universe
+    with open(dict_file, 'r') as dic_file:
+        return Bitmap.from_docIDs([int(x) for x in dic_file.readline().split()])
+
+def read_entries(dict_file):
+    '''
+    stream the (term, doc_freq, pointer, num_bytes, representation) entries of a dictionary file in alphabetical order
+    '''
+    if is_binary_dictionary(dict_file):
+        dictionary = BinaryDictionary(dict_file)
+        yield from dictionary.entries()
+        dictionary.close()
+        return
+    with open(dict_file, 'r') as dic_file:
+        dic_file.readline()
+        for line in dic_file:
+            yield parse_text_entry(line)
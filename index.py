@@ -1,25 +1,52 @@
 #!/usr/bin/python3
 import getopt
-import linecache
-import nltk
+import io
+import multiprocessing
 import os
 import re
+import resource
 import shutil
+import subprocess
 import sys
+import tracemalloc
 
+from array import array
+from bisect import bisect_left
 from collections import deque
+from contextlib import ExitStack
 from heapq import merge
-from itertools import islice
-from math import floor, sqrt
-from typing import Dict, Deque
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import Dict
+
+from analysis import TOKENIZERS, Analyzer, read_tokenizer, tokenizer_file, write_tokenizer
+from bitmap import Bitmap, decode_bitmap, encode_bitmap
+from corpus import batch_documents, read_documents
+from dictionary import DICTIONARY_FORMATS, BinaryDictionaryWriter, TextDictionaryWriter, read_entries, read_universe
+from postings import (BINARY_MAGIC, POSTINGS_FORMATS, PostingsReader, decode_block_postings, decode_postings, decode_text_postings,
+                      encode_block_postings, skip_interval)
+from segments import (add_tombstones, list_segments, manifest_file, manifest_lock, merge_lock,
+                      read_manifest, read_tombstones, segment_files, select_merge, tombstone_file, write_manifest)
+from shards import (list_shards, read_shard_manifest, shard_files, shard_manifest_file, shard_ranges, split_by_shard,
+                    write_shard_manifest)
+from wildcard import KGramIndexWriter, kgram_file
 
 TEST_MODE = False
 VERBOSE = False
+POSTINGS_FORMAT = 'binary'
+DICTIONARY_FORMAT = 'binary'
+TOKENIZER = 'nltk'              # tokenizer of a full build, see analysis.py
+NUM_WORKERS = 1
+NUM_SHARDS = 1                  # number of docID ranges the collection is partitioned into, see shards.py
+INDEX_MODE = 'build'            # build, add (documents as a new segment), delete (docIDs) or merge (segments)
+DELETED_DOCS_FILE = None
+MEMORY_BUDGET = None            # MB of memory for the blocks of all workers, see the end of the file for defaults
+BITMAP_DENSITY = 1/16           # binary postings lists of terms in at least this fraction of documents are stored as bitmaps
 AUXILIARY_DICT = 'd'
 AUXILIARY_POST = 'p'
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file -t (optional flag for test mode)")
+    print("usage: " + sys.argv[0] + " -i directory-or-archive-or-jsonl-file-of-documents -d dictionary-file -p postings-file -t (optional flag for test mode) -f binary|text (optional postings format, default binary) -D binary|text (optional dictionary format, default binary) -T nltk|regex (optional tokenizer, default nltk) -j number-of-worker-processes (optional, default 1) -m memory-budget-in-MB (optional, default 32) -a (optional flag to add the new documents as a segment) -x file-of-docIDs-to-delete (optional) -M (optional flag to merge segments) -s number-of-shards (optional, default 1)")
 
 
 class DictionaryEntry:
@@ -27,9 +54,16 @@ class DictionaryEntry:
     Represents a term dictionary entry that contains document frequency 
     and the pointer to associated postings list in the postings file
     '''
+    __slots__ = ('doc_freq', 'postings')
+
     def __init__(self, postings_address, doc_freq=1):
         self.doc_freq = doc_freq
         self.postings = postings_address
+
+# estimated bytes of memory used by a new term besides its string: its dictionary entry and dict slot,
+# and its postings array and list slot. Every further posting adds one array item.
+TERM_OVERHEAD = sys.getsizeof(DictionaryEntry(0)) + 3 * 8 + sys.getsizeof(array('I', [0])) + 8
+POSTING_BYTES = array('I').itemsize
         
 class Index:
     '''
@@ -40,7 +74,10 @@ class Index:
         Constructor
         '''
         self.term_dictionary: Dict[str, DictionaryEntry] = {}
-        self.postings: [str] = []
+        self.postings: [array] = []         # postings list of every term ID, as unsigned int arrays
+        self.estimated_size = 0             # estimated bytes of memory used by the terms and postings
+        self.last_doc_ID = 0
+        self.in_order = True                # whether the documents were inserted in increasing docID order
         
     def __len__(self):
         '''
@@ -48,20 +85,35 @@ class Index:
         '''
         return len(self.term_dictionary)
         
-    def insert(self, term:str, doc_ID:str, doc_freq:int=1):
+    def start_document(self, doc_ID:int):
+        '''
+        Start inserting the terms of a document. Documents are usually inserted in increasing docID order,
+        otherwise the postings lists are sorted when the index is written (see write_block)
+        '''
+        if doc_ID < self.last_doc_ID:
+            self.in_order = False
+        self.last_doc_ID = doc_ID
+
+    def insert(self, term:str, doc_ID:int, doc_freq:int=1):
         '''
         Insert a given term into the index with the document ID from which it was obtained.
         Optionally provide a document frequency, otherwise the default value is 1.
+        All the terms of a document must be inserted before the next document is started.
         '''
+        entry = self.term_dictionary.get(term)
         # if the term is in the index already, 
-        if term in self.term_dictionary.keys():
-            if doc_ID not in self.postings[self.term_dictionary[term].postings - 1]:
+        if entry is not None:
+            postings = self.postings[entry.postings - 1]
+            # documents are inserted one at a time, so a repeated docID can only be the last one
+            if postings[-1] != doc_ID:
                 # add the docID to the postings list if it is unique and increment the doc_freq
-                self.postings[self.term_dictionary[term].postings - 1] += f",{doc_ID}"
-                self.term_dictionary[term].doc_freq += 1
-        else: # otherwise, create a new entry in the index
-            self.term_dictionary[term] = DictionaryEntry(postings_address=len(self.postings) + 1)
-            self.postings.append(doc_ID)
+                postings.append(doc_ID)
+                entry.doc_freq += 1
+                self.estimated_size += POSTING_BYTES
+        else: # otherwise, intern the term and give it the next term ID
+            self.term_dictionary[sys.intern(term)] = DictionaryEntry(postings_address=len(self.postings) + 1)
+            self.postings.append(array('I', [doc_ID]))
+            self.estimated_size += sys.getsizeof(term) + TERM_OVERHEAD
             
     def termwise_sort(self):
         '''
@@ -73,16 +125,163 @@ class Index:
 
 def build_index(in_dir, out_dict, out_postings):
     """
-    build index from documents stored in the input directory,
-    then output the dictionary file and postings file
+    build index from documents stored in the input directory, archive or JSONL file (see corpus.py),
+    then output the dictionary file and postings file, or with more than one shard,
+    the dictionary and postings file of every shard (see shards.py)
     """
     print('indexing...')
+    clear_shards(out_dict, out_postings)
+    clear_segments(out_dict, out_postings)
+    clear_auxiliary_dirs()
+    doc_ids = construct_blocks(in_dir, NUM_WORKERS, tokenizer=TOKENIZER)
+    if NUM_SHARDS > 1:
+        first_doc_ids = shard_ranges(doc_ids, NUM_SHARDS)
+        shards = [shard_files(out_dict, out_postings, shard_number) for shard_number in range(len(first_doc_ids))]
+        merge_blocks([(*shard, shard_doc_ids) for shard, shard_doc_ids in zip(shards, split_by_shard(doc_ids, first_doc_ids))])
+        for shard_dict, _ in shards:
+            write_tokenizer(shard_dict, TOKENIZER)
+        # the shards are only searched once they are all complete
+        write_shard_manifest(out_dict, first_doc_ids)
+        if VERBOSE: print(f"wrote {len(shards)} shards starting at docIDs {first_doc_ids}")
+    else:
+        merge_blocks([(out_dict, out_postings, doc_ids)])
+    write_tokenizer(out_dict, TOKENIZER)
+
+def add_documents(in_dir, out_dict, out_postings):
+    """
+    index the documents of the input directory, archive or JSONL file that are not in the index yet into a new immutable segment
+    (see segments.py), leaving the dictionary and postings files of the existing segments untouched.
+    The new documents of a sharded index are added to a new segment of the shard of their docID range (see shards.py).
+    Small segments are then merged in the background
+    """
+    first_doc_ids = read_shard_manifest(out_dict)
+    if first_doc_ids is None and not os.path.exists(manifest_file(out_dict)) and not os.path.exists(out_dict):
+        build_index(in_dir, out_dict, out_postings)
+        return
+    print('adding documents...')
+    shards = list_shards(out_dict, out_postings)
+    segment_numbers = []
+    for shard_dict, _ in shards:
+        with manifest_lock(shard_dict):
+            manifest = read_manifest(shard_dict)
+            if manifest is None:        # the index of the full build becomes segment 0
+                manifest = (1, [(0, len(read_universe(shard_dict)))])
+            segment_number, segments = manifest
+            write_manifest(shard_dict, segment_number + 1, segments)       # reserve the segment number
+        segment_numbers.append(segment_number)
+
+    indexed = 0
+    for shard_dict, shard_postings in shards:
+        for segment_dict, _ in list_segments(shard_dict, shard_postings):
+            indexed |= read_universe(segment_dict).bits
+    indexed = Bitmap(indexed)
     clear_auxiliary_dirs()
-    construct_blocks(in_dir)
-    final_merged_index = merge_blocks(out_dict, out_postings)
-    copy_to_output_postings(final_merged_index, out_postings)
-    copy_to_output_dict(final_merged_index, out_dict, out_postings)
-    add_doc_id_list(in_dir, out_dict)
+    # new documents are always analyzed like the rest of the index
+    doc_ids = construct_blocks(in_dir, NUM_WORKERS, indexed, read_tokenizer(out_dict))
+    if not doc_ids:
+        print('no new documents')
+        return
+    shard_doc_ids = split_by_shard(doc_ids, first_doc_ids or [0])
+    added = [shard for shard in range(len(shards)) if shard_doc_ids[shard]]
+    merge_blocks([(*segment_files(*shards[shard], segment_numbers[shard]), shard_doc_ids[shard]) for shard in added])
+
+    # the segment is only searched once it is complete and listed in the manifest
+    for shard in added:
+        shard_dict, shard_postings = shards[shard]
+        with manifest_lock(shard_dict):
+            next_segment_number, segments = read_manifest(shard_dict)
+            segments.append((segment_numbers[shard], len(shard_doc_ids[shard])))
+            write_manifest(shard_dict, next_segment_number, segments)
+        if VERBOSE: print(f"added segment {segment_numbers[shard]} of {shard_dict} with {len(shard_doc_ids[shard])} documents")
+        if select_merge(segments):
+            start_background_merge(shard_dict, shard_postings)
+
+def delete_documents(out_dict, out_postings, deleted_docs_file):
+    """
+    delete the docIDs listed in the given file from the index by adding them to its tombstone bitmap,
+    or to the tombstone bitmap of the shard of their docID range. Their postings are dropped when their segments are merged
+    """
+    with open(deleted_docs_file, "r") as doc_ids_file:
+        doc_ids = [int(doc_id) for doc_id in doc_ids_file.read().split()]
+    shard_doc_ids = split_by_shard(sorted(doc_ids), read_shard_manifest(out_dict) or [0])
+    for (shard_dict, _), deleted in zip(list_shards(out_dict, out_postings), shard_doc_ids):
+        if deleted:
+            add_tombstones(shard_dict, deleted)
+    print(f"deleted {len(doc_ids)} documents")
+
+def start_background_merge(out_dict, out_postings):
+    """
+    merge the segments of the index in a detached process, so that adding documents returns immediately
+    """
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "-d", out_dict, "-p", out_postings,
+                      "-f", POSTINGS_FORMAT, "-D", DICTIONARY_FORMAT, "-m", str(MEMORY_BUDGET), "-M"], start_new_session=True)
+
+def merge_segments(out_dict, out_postings):
+    """
+    Merge the segments chosen by the tiered merge policy (see segments.py) until no merge is needed.
+    Only one merge runs at a time, and the manifest is only locked to choose the segments and
+    to swap them for the merged segment, so documents can be added and searched during a merge.
+    The segments of every shard of a sharded index are merged separately
+    """
+    if read_shard_manifest(out_dict) is not None:
+        for shard_dict, shard_postings in list_shards(out_dict, out_postings):
+            merge_segments(shard_dict, shard_postings)
+        return
+    with merge_lock(out_dict) as acquired:
+        if not acquired:            # another merge is already running
+            return
+        while True:
+            with manifest_lock(out_dict):
+                manifest = read_manifest(out_dict)
+                if manifest is None:
+                    return
+                merged_number, segments = manifest
+                selected = select_merge(segments)
+                if not selected:
+                    return
+                write_manifest(out_dict, merged_number + 1, segments)        # reserve the segment number
+            if VERBOSE: print(f"merging segments {selected} into segment {merged_number}")
+
+            num_docs = merge_segment_files(out_dict, out_postings, selected, merged_number)
+            with manifest_lock(out_dict):
+                next_segment_number, segments = read_manifest(out_dict)
+                segments = [segment for segment in segments if segment[0] not in selected]
+                segments.append((merged_number, num_docs))
+                write_manifest(out_dict, next_segment_number, segments)
+            # searches that already opened the old segments keep reading them until they close them
+            for segment_number in selected:
+                segment_dict, segment_postings = segment_files(out_dict, out_postings, segment_number)
+                for file_name in (segment_dict, segment_postings, kgram_file(segment_dict)):
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+
+def clear_segments(out_dict, out_postings):
+    '''
+    remove the segments, manifest and tombstones of a previous incrementally built index
+    '''
+    manifest = read_manifest(out_dict)
+    if manifest is not None:
+        for segment_number, _ in manifest[1]:
+            segment_dict, segment_postings = segment_files(out_dict, out_postings, segment_number)
+            for file_name in (segment_dict, segment_postings, kgram_file(segment_dict)):
+                if segment_number != 0 and os.path.exists(file_name):
+                    os.remove(file_name)
+        os.remove(manifest_file(out_dict))
+    if os.path.exists(tombstone_file(out_dict)):
+        os.remove(tombstone_file(out_dict))
+
+def clear_shards(out_dict, out_postings):
+    '''
+    remove the shards, with their segments, and the shard manifest of a previous sharded index
+    '''
+    if read_shard_manifest(out_dict) is None:
+        return
+    for shard_dict, shard_postings in list_shards(out_dict, out_postings):
+        clear_segments(shard_dict, shard_postings)
+        for file_name in (shard_dict, shard_postings, kgram_file(shard_dict), tokenizer_file(shard_dict)):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+    os.remove(shard_manifest_file(out_dict))
 
 def clear_auxiliary_dirs():
     '''
@@ -95,65 +294,124 @@ def clear_auxiliary_dirs():
         for file_name in os.listdir(AUXILIARY_POST):
             os.remove(f"{AUXILIARY_POST}/{file_name}")
 
-def construct_blocks(in_dir):
+def construct_blocks(source, num_workers=1, indexed=frozenset(), tokenizer='nltk'):
     '''
-    Parse all files in in_dir and create a partitioned index in "blocks"
+    Parse all documents of the source, a directory, archive or JSONL file (see corpus.py), except the docIDs
+    already indexed, and create a partitioned index in "blocks". The documents are streamed in a single pass,
+    which also collects their docIDs.
+    With more than one worker, the stream is split into batches of documents, and every batch is tokenized,
+    stemmed and written to its own blocks by one of the worker processes. At most 2 batches per worker are
+    read ahead of the workers. The MAX_BLOCK_BYTES memory budget is shared equally by the workers.
+    Documents are analyzed with the given tokenizer (see analysis.py).
+    Returns the sorted docIDs of the documents parsed
     '''
-    stemmer = nltk.stem.porter.PorterStemmer()      # one persistent stemmer object
-    file_list = os.listdir(in_dir)                  # obtain list of document names
-    file_list.sort(key=lambda f: int(f))            # sort document names in algebraically increasing order
-    
+    doc_ids = []
+
+    def documents():
+        for doc_id, text in read_documents(source, indexed):
+            doc_ids.append(doc_id)
+            yield doc_id, text
+
+    stream = documents()
+    if TEST_MODE:                                   # test mode parses only 100 documents
+        stream = islice(stream, 100)
+
     if not os.path.exists(AUXILIARY_DICT): os.makedirs(AUXILIARY_DICT+'/')
     if not os.path.exists(AUXILIARY_POST): os.makedirs(AUXILIARY_POST+'/')
-    
+
+    if num_workers > 1:
+        # block names are prefixed with the batch number so that workers never write to the same block
+        max_block_bytes = MAX_BLOCK_BYTES // num_workers
+        with multiprocessing.Pool(num_workers, initializer=init_index_worker, initargs=(tokenizer,)) as pool:
+            pending = deque()
+            for batch_number, batch in enumerate(batch_documents(stream, max_block_bytes // 2)):
+                if len(pending) == 2 * num_workers:
+                    pending.popleft().get()
+                pending.append(pool.apply_async(construct_batch_blocks, (batch, max_block_bytes, f"{batch_number}_")))
+            for result in pending:
+                result.get()
+    else:
+        construct_shard_blocks(stream, MAX_BLOCK_BYTES, tokenizer=tokenizer)
+    # documents of archives and JSONL files may come in any order
+    return sorted(doc_ids)
+
+# Analyzer of a worker process of construct_blocks, created once per process by init_index_worker
+worker_analyzer = None
+
+def init_index_worker(tokenizer):
+    global worker_analyzer
+    worker_analyzer = Analyzer(tokenizer)
+
+def construct_batch_blocks(documents, max_block_bytes, block_prefix):
+    '''
+    write the partitioned index of a batch of documents with the Analyzer of the worker process
+    '''
+    construct_shard_blocks(documents, max_block_bytes, block_prefix, analyzer=worker_analyzer)
+
+def construct_shard_blocks(documents, max_block_bytes, block_prefix="", tokenizer='nltk', analyzer=None):
+    '''
+    Parse the given (docID, text) documents in order and write their partitioned index to
+    the blocks named {block_prefix}0, {block_prefix}1, ...
+    A block is written to disk once its estimated size reaches max_block_bytes
+    '''
+    if VERBOSE: tracemalloc.start()                 # measure the memory of every block in verbose mode
+    if analyzer is None:
+        analyzer = Analyzer(tokenizer)              # one persistent analyzer, memoizing the stems of the shard
     index = Index()                                 # initialize the index object
     block_index = 0                                 # track block numbers for filenaming
-    num_files = 0                                   # counter for running test mode, which parses only 100 files
-    if VERBOSE: print(f"starting new block ({block_index})")
-    for file in file_list:
-        if TEST_MODE and num_files == 100:
-            break
-        num_files += 1
-        with open(f"{in_dir}/{file}", "r") as doc:
-            for line in doc:
-                for token in tokenize(stemmer, line):                           # tokenize and stem the files
-                    index.insert(term=token, doc_ID=file)
-                if len(index) > MAX_BLOCK_SIZE:                                 # if the index size exceeds the allocated block size,
-                    if VERBOSE: print(f"starting new block ({block_index})")     # write to disk to free memory and start the next block
-                    write_block(index, block_index)
-                    block_index += 1
-                    index = Index()
-                
+    if VERBOSE: print(f"starting new block ({block_prefix}{block_index})")
+    for doc_ID, text in documents:
+        index.start_document(doc_ID)
+        for line in text.split("\n"):
+            for token in analyzer.analyze(line):                                # tokenize and stem the documents
+                index.insert(term=token, doc_ID=doc_ID)
+            if index.estimated_size >= max_block_bytes:                         # if the index size exceeds the allocated block size,
+                if VERBOSE: print(f"starting new block ({block_prefix}{block_index})")     # write to disk to free memory and start the next block
+                if VERBOSE: log_block_memory(index, f"{block_prefix}{block_index}")
+                write_block(index, f"{block_prefix}{block_index}")
+                block_index += 1
+                index = Index()
+                index.start_document(doc_ID)
+
     # flush remaining data to disk
-    if len(index) > 0:                                                          # once all files are parsed, write whatever is left
-        if VERBOSE: print(f"writing last block ({block_index})")                 # in the index to disk
-        write_block(index, block_index)                 
-        
-def tokenize(stemmer, line):
+    if len(index) > 0:                                                          # once all documents are parsed, write whatever is left
+        if VERBOSE: print(f"writing last block ({block_prefix}{block_index})")   # in the index to disk
+        if VERBOSE: log_block_memory(index, f"{block_prefix}{block_index}")
+        write_block(index, f"{block_prefix}{block_index}")
+    if VERBOSE: print(analyzer)
+    if VERBOSE: tracemalloc.stop()
+
+def log_block_memory(index: Index, block_index):
     '''
-    Given a stemmer object and a list of words,
-    return a list of these words tokenized and stemmed using
-    nltk.word_tokenize and the porter stemming algorithm
+    print the estimated size of a block next to its measured memory: the current and peak
+    memory traced by tracemalloc since the previous block, and the peak RSS of the process.
+    The traces are restarted so that the next block is measured on its own
     '''
-    tokenized = nltk.word_tokenize(line)
-    # UNCOMMENT THIS IF PUNCTUATION REMOVAL IS DESIRED
-    # pattern = r'[!"#$%&\'()*+,\-./:;<=>?@[\\\]^_`{|}~]+'
-    # tokenized = filter(lambda x: not re.fullmatch(pattern, x), tokenized)
-    return [stemmer.stem(token) for token in tokenized]
-
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss        # in KB on Linux
+    print(f"block {block_index}: {len(index)} terms, estimated {index.estimated_size / 2**20:.2f} MB, "
+          f"tracemalloc {traced / 2**20:.2f} MB (peak {traced_peak / 2**20:.2f} MB), peak RSS {peak_rss / 2**10:.2f} MB")
+    tracemalloc.stop()
+    tracemalloc.start()
+        
 def write_block(index: Index, block_index):
     '''
-    given an index object and its partition index, save it to disk
+    given an index object and its partition index, save it to disk.
+    This is the only place where the postings arrays are serialized to text.
+    The postings lists are written in the same (alphabetical) order as the dictionary,
+    so that both files of a block can be streamed side by side when merging
     '''
     # sort dictionary by terms before storing
     dictionary = index.termwise_sort().term_dictionary
     postings = index.postings
-    with open(f'{AUXILIARY_DICT}/d{block_index}.txt', "w") as dictionary_file:
-        for term, entry in dictionary.items():
-            dictionary_file.write(format_dict_entry(term, entry.doc_freq, entry.postings))
-    with open(f'{AUXILIARY_POST}/p{block_index}.txt', "w") as postings_file:
-        for posting_list in postings:
-            postings_file.write(f"{posting_list}\n")
+    # documents read out of docID order leave unsorted postings lists
+    if not index.in_order:
+        postings = [sorted(postings_list) for postings_list in postings]
+    with open(f'{AUXILIARY_DICT}/d{block_index}.txt', "w") as dictionary_file, \
+        open(f'{AUXILIARY_POST}/p{block_index}.txt', "w") as postings_file:
+        for line_num, (term, entry) in enumerate(dictionary.items(), 1):
+            dictionary_file.write(format_dict_entry(term, entry.doc_freq, line_num))
+            postings_file.write(",".join(map(str, postings[entry.postings - 1])) + "\n")
             
 def format_dict_entry(term, doc_freq, postings):
     '''
@@ -161,174 +419,199 @@ def format_dict_entry(term, doc_freq, postings):
     '''
     return f"{term} {doc_freq} {postings}\n"
 
-'''
-Driver method for merging intermediate blocks.
-Treats AUXILIARY_DICT directory as a FIFO queue as part of the merge algorithm on
-all index partitions created in construct_blocks().
-Returns index of final merged block
-'''
-def merge_blocks(out_dict, out_postings):
-    blocks = deque(os.listdir(AUXILIARY_DICT))
-    next_block_number = len(blocks)
-    while len(os.listdir(AUXILIARY_DICT)) > 1:
-        # add new merged block to queue for subsequent merging
-        blocks.append(block_merge(blocks[0], blocks[1], next_block_number))
-        if VERBOSE: print(f"removing {blocks[0]} and {blocks[1]} and their postings files")
-        os.remove(f"{AUXILIARY_POST}/p{blocks[0][1:]}")
-        os.remove(f"{AUXILIARY_DICT}/{blocks.popleft()}")
-        os.remove(f"{AUXILIARY_POST}/p{blocks[0][1:]}")
-        os.remove(f"{AUXILIARY_DICT}/{blocks.popleft()}")
-        next_block_number += 1
-    if VERBOSE: print(f"Index of final block: {next_block_number-1}")
-    return next_block_number - 1
-    
-'''
-Consumes two blocks to merge, returns name of merged block
-Because it is a 2-way merge, each block is processed one half 
-at a time. This is based off the assumption that we can only
-afford one total block's worth of memory.  
-Realistically, since we are also chunking the output disk-writes,
-we would need to chunk the inputs in thirds to accomodate for 
-the memory consumption of the output buffer. 
-'''
-def block_merge(block_A, block_B, next_block_number):
-    if VERBOSE: print(f"Merging {block_A} and {block_B} to make block_{next_block_number}.")
-    with open(f"{AUXILIARY_DICT}/{block_A}", "r") as d_A, open(f"d/{block_B}", "r") as d_B:
-            
-        dict_output_buffer = []        
-        post_output_buffer = []
-        
-        def write_to_buffer(term, df, index, postings):
-            '''
-            To minimize disk-writes, we also chunk the output. This function
-            adds data to the buffer to be written to the dictionary and postings files.
-            '''
-            nonlocal dict_output_buffer
-            nonlocal post_output_buffer
-            dict_output_buffer.append(format_dict_entry(term, df, index))
-            post_output_buffer.append(postings)
-        
-        def flush_buffered_chunk():
-            '''
-            Flush output chunk to disk
-            '''
-            nonlocal dict_output_buffer
-            nonlocal post_output_buffer
-            with open(f"{AUXILIARY_DICT}/d{(next_block_number)}.txt", "a") as merged_dict:
-                merged_dict.writelines(dict_output_buffer)
-                dict_output_buffer = []
-            with open(f"{AUXILIARY_POST}/p{next_block_number}.txt", "a") as merged_postings:
-                merged_postings.writelines(post_output_buffer)
-                post_output_buffer = []
-        
-        # Must re-index the postings pointers 
-        new_entry_index = 1
-
-        # use FIFO queues to maintain alphabetical order
-        chunk_A = deque(islice(d_A, CHUNK_SIZE))
-        chunk_B = deque(islice(d_B, CHUNK_SIZE))
-        # if either file empties, stop doing comparisons for merge
-        while chunk_A and chunk_B:
-            # get the next entries
-            term_A, df_A, postings_A = chunk_A[0].strip().split(" ")
-            term_B, df_B, postings_B = chunk_B[0].strip().split(" ")
-            # if next term in chunk A alphabetically precedes 
-            # the next term in chunk B, add it to the buffer
-            if term_A < term_B:
-                postings = linecache.getline(f"{AUXILIARY_POST}/p{block_A[1:]}", int(postings_A))
-                write_to_buffer(term_A, df_A, new_entry_index, postings)
-                chunk_A.popleft()
-            # if term A and term B are the same, merge their postings lists,
-            # add their document frequencies and add the merged entry to the buffer
-            elif term_A == term_B:
-                df = str(int(df_A) + int(df_B))
-                # sorted postings list are read from disk and then converted into integer lists for merging with heapq.merge()
-                postings_list_A = [int(x) for x in linecache.getline(f"{AUXILIARY_POST}/p{block_A[1:]}", int(postings_A)).strip().split(",")]
-                postings_list_B = [int(x) for x in linecache.getline(f"{AUXILIARY_POST}/p{block_B[1:]}", int(postings_B)).strip().split(",")]
-                postings_list_merged = ','.join([str(x) for x in merge(postings_list_A, postings_list_B)])
-                write_to_buffer(term_A, df, new_entry_index, f'{postings_list_merged}\n')
-                chunk_A.popleft()
-                chunk_B.popleft()
-            # if term B precedes term A, add it to the buffer
-            elif term_A > term_B:
-                postings = linecache.getline(f"{AUXILIARY_POST}/p{block_B[1:]}", int(postings_B))
-                write_to_buffer(term_B, df_B, new_entry_index, postings)
-                chunk_B.popleft()
-            new_entry_index+=1
-            # if either chunk runs out, load the next chunk for that file and flush the buffer
-            if not chunk_A:
-                chunk_A = deque(islice(d_A, CHUNK_SIZE))
-                flush_buffered_chunk()
-            if not chunk_B:
-                chunk_B = deque(islice(d_B, CHUNK_SIZE))
-                flush_buffered_chunk()
-            
-        # once either chunk is empty, write the remainder
-        while chunk_A:
-            term_A, df_A, postings_A = chunk_A.popleft().strip().split(" ")
-            postings = linecache.getline(f"{AUXILIARY_POST}/p{block_A[1:]}", int(postings_A))
-            write_to_buffer(term_A, df_A, new_entry_index, postings)
-            new_entry_index+=1
-            # if chunk_A runs out, try to load another chunk
-            if not chunk_A: chunk_A = deque(islice(d_A, CHUNK_SIZE))
-        while chunk_B:
-            term_B, df_B, postings_B = chunk_B.popleft().strip().split(" ")
-            postings = linecache.getline(f"{AUXILIARY_POST}/p{block_B[1:]}", int(postings_B))
-            write_to_buffer(term_B, df_B, new_entry_index, postings)
-            new_entry_index+=1
-            # if chunk_B runs out, try to load another chunk
-            if not chunk_B: chunk_B = deque(islice(d_B, CHUNK_SIZE))
-        flush_buffered_chunk()
-                
-    return f"d{(next_block_number)}.txt"
-
-def add_doc_id_list(in_dir, out_dict):
-    '''
-    Add a list of all document IDs to the dictionary file to
-    facilitate NOT queries in search.py
-    '''
-    file_list = os.listdir(in_dir)
-    file_list.sort(key=lambda f: int(f))
-    with open(out_dict, "r+") as dictionary_file:
-        dictionary_content = dictionary_file.read()
-        dictionary_file.seek(0,0)
-        dictionary_file.write(f'{" ".join(file_list)}\n{dictionary_content}')
+def block_order(block_name):
+    '''
+    return the position of a block in docID order from its file name,
+    e.g. d7.txt -> (7,) and d2_5.txt (shard 2, block 5) -> (2, 5)
+    '''
+    return tuple(int(number) for number in block_name[1:-len(".txt")].split("_"))
+
+def read_block(dict_file, postings_file, rank):
+    '''
+    Stream the (term, rank, postings) entries of a block in alphabetical order.
+    The rank of the block breaks ties between blocks with the same term in docID order
+    '''
+    for dict_entry, postings in zip(dict_file, postings_file):
+        term, doc_freq, line_num = dict_entry.strip().split(" ")
+        yield term, rank, postings.strip()
+
+def merge_blocks(outputs):
+    '''
+    Merge all blocks created in construct_blocks() into the dictionary and postings files of outputs in a single pass,
+    a list of (dictionary file, postings file, sorted docIDs) of a single index or of every shard (see write_index).
+    Every block's dictionary and postings files are opened at once and streamed sequentially,
+    and a heap merges their terms in alphabetical order. Blocks usually hold increasing ranges of docIDs,
+    so the postings of a term are the concatenation of its postings in every block, in block order.
+    The blocks of documents read out of docID order overlap, and their postings are merged instead.
+    Half of the memory budget is shared by the read buffers of the blocks, the other half buffers the output.
+    '''
+    block_names = sorted(os.listdir(AUXILIARY_DICT), key=block_order)
+    if VERBOSE: print(f"merging {len(block_names)} blocks")
+    read_buffer_size = max(io.DEFAULT_BUFFER_SIZE, CHUNK_SIZE // (2 * max(len(block_names), 1)))
+    with ExitStack() as stack:
+        blocks = []
+        for rank, block_name in enumerate(block_names):
+            dict_file = stack.enter_context(open(f"{AUXILIARY_DICT}/{block_name}", "r", buffering=read_buffer_size))
+            postings_file = stack.enter_context(open(f"{AUXILIARY_POST}/p{block_name[1:]}", "r", buffering=read_buffer_size))
+            blocks.append(read_block(dict_file, postings_file, rank))
+
+        def merged_entries():
+            for term, entries in groupby(merge(*blocks), key=itemgetter(0)):
+                postings_list = []
+                for _, _, block_postings in entries:
+                    block_doc_ids = [int(docID) for docID in block_postings.split(",")]
+                    # a document split across two blocks ends one run and starts the next
+                    if postings_list and postings_list[-1] == block_doc_ids[0]:
+                        block_doc_ids = block_doc_ids[1:]
+                    if postings_list and block_doc_ids and block_doc_ids[0] < postings_list[-1]:
+                        postings_list = [docID for docID, _ in groupby(merge(postings_list, block_doc_ids))]
+                    else:
+                        postings_list.extend(block_doc_ids)
+                yield term, postings_list
+
+        write_index(outputs, merged_entries())
+
+def read_segment(segment_dict, postings_reader, rank):
+    '''
+    Stream the (term, rank, postings) entries of a segment in alphabetical order,
+    decoding every postings list from the memory-mapped postings file of the segment
+    '''
+    for term, doc_freq, pointer, num_bytes, representation in read_entries(segment_dict):
+        postings = postings_reader.read(pointer, num_bytes)
+        if representation == "b":
+            yield term, rank, list(decode_bitmap(postings))
+        elif postings_reader.blocked:
+            yield term, rank, decode_block_postings(postings)
+        elif postings_reader.binary:
+            yield term, rank, decode_postings(postings)
+        else:
+            yield term, rank, decode_text_postings(postings)
+
+def merge_segment_files(out_dict, out_postings, segment_numbers, merged_number):
+    '''
+    Merge the given segments into the new segment merged_number in a single pass, like merge_blocks().
+    Segments hold disjoint docIDs, so the postings of a term are a heap merge of its postings in every segment.
+    Deleted docIDs are dropped from the merged segment.
+    Returns the number of documents of the merged segment
+    '''
+    tombstones = read_tombstones(out_dict)
+    with ExitStack() as stack:
+        segments = []
+        universe = 0
+        for rank, segment_number in enumerate(segment_numbers):
+            segment_dict, segment_postings = segment_files(out_dict, out_postings, segment_number)
+            universe |= read_universe(segment_dict).bits
+            postings_reader = stack.enter_context(PostingsReader(segment_postings))
+            segments.append(read_segment(segment_dict, postings_reader, rank))
+        doc_ids = list(Bitmap(universe & ~tombstones.bits))
+
+        def merged_entries():
+            for term, entries in groupby(merge(*segments), key=itemgetter(0)):
+                postings_list = [doc_id for doc_id in merge(*(postings for _, _, postings in entries))
+                                 if doc_id not in tombstones]
+                if postings_list:
+                    yield term, postings_list
+
+        write_index([(*segment_files(out_dict, out_postings, merged_number), doc_ids)], merged_entries())
+    return len(doc_ids)
+
+def write_index(outputs, entries):
+    '''
+    Write the (term, postings list) entries, in alphabetical order, to the dictionary and postings files of outputs,
+    a list of (dictionary file, postings file, sorted docIDs): a single index, or the shards of a sharded index in
+    docID order (see shards.py). Shards hold increasing ranges of docIDs, so the postings list of a term is cut at
+    the first docID of every shard, and every shard only gets the terms of its own documents.
+    The output buffer of CHUNK_SIZE bytes is shared by the outputs (see IndexWriter)
+    '''
+    with ExitStack() as stack:
+        writers = [stack.enter_context(IndexWriter(out_dict, out_postings, doc_ids, CHUNK_SIZE // len(outputs)))
+                   for out_dict, out_postings, doc_ids in outputs]
+        if len(writers) == 1:
+            for term, postings_list in entries:
+                writers[0].add(term, postings_list)
+            return
+        first_doc_ids = [doc_ids[0] for _, _, doc_ids in outputs[1:]]
+        for term, postings_list in entries:
+            cuts = [0] + [bisect_left(postings_list, first_doc_id) for first_doc_id in first_doc_ids] + [len(postings_list)]
+            for writer, start, stop in zip(writers, cuts, cuts[1:]):
+                if start < stop:
+                    writer.add(term, postings_list[start:stop])
+
+
+class IndexWriter:
+    '''
+    Writes (term, postings list) entries, added in alphabetical order, to an output dictionary and postings file.
+    The dictionary is written in DICTIONARY_FORMAT (see dictionary.py), starting with all docIDs of the index
+    to facilitate NOT queries in search.py, so that the dictionary never has to be rewritten.
+    The postings are written in chunks of chunk_size bytes, with the dictionary
+    pointing to the byte offset and byte length of each postings list.
+    The k-gram index of the terms is written next to the dictionary for wildcard queries (see wildcard.py)
+    '''
+    def __init__(self, out_dict, out_postings, doc_ids, chunk_size):
+        '''
+        Constructor
+        '''
+        dictionary_writer = BinaryDictionaryWriter if DICTIONARY_FORMAT == 'binary' else TextDictionaryWriter
+        self.num_docs = len(doc_ids)
+        self.chunk_size = chunk_size
+        self.out_dict_file = dictionary_writer(out_dict, doc_ids, max(io.DEFAULT_BUFFER_SIZE, chunk_size // 4))
+        self.out_postings_file = open(out_postings, "wb")
+        self.kgram_index = KGramIndexWriter(out_dict)
+        self.total_offset = 0
+        if POSTINGS_FORMAT == 'binary':
+            self.out_postings_file.write(BINARY_MAGIC)
+            self.total_offset = len(BINARY_MAGIC)
+        self.post_output_buffer = []
+        self.buffered_bytes = 0
+
+    def add(self, term, postings_list):
+        encoded, representation = encode_postings_list(postings_list, self.num_docs)
+        self.out_dict_file.add(term, len(postings_list), self.total_offset, len(encoded), representation)
+        self.kgram_index.add(term)
+        self.post_output_buffer.append(encoded)
+        self.total_offset += len(encoded)
+        self.buffered_bytes += len(encoded)
+        # to minimize disk-writes, the output is flushed one chunk at a time
+        if self.buffered_bytes >= self.chunk_size:
+            self.out_postings_file.writelines(self.post_output_buffer)
+            self.post_output_buffer = []
+            self.buffered_bytes = 0
+
+    def close(self):
+        self.out_postings_file.writelines(self.post_output_buffer)
+        self.out_postings_file.close()
+        self.out_dict_file.close()
+        self.kgram_index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def encode_postings_list(postings_list, num_docs):
+    '''
+    Encode a sorted list of docIDs for the output postings file using POSTINGS_FORMAT.
+    Returns the encoded bytes and the representation of the postings list,
+    "b" for a bitmap and "l" for a list of docIDs.
     
-def copy_to_output_dict(aux_file_index, out_dict, postings_file):
-    '''
-    Copies term_dict_file to out_dict, converting the line-number pointers into byte-offset pointers
-    '''
-    with open(f"{AUXILIARY_DICT}/d{aux_file_index}.txt", "r") as term_dict, \
-        open(postings_file, "r") as postings, \
-        open(out_dict, "w") as out_dict_file:
-        total_offset = 0
-        for dict_entry, posting_list in zip(term_dict, postings):
-            term, doc_freq, line_num = dict_entry.strip().split(" ")
-            postings_list_len = len(posting_list.encode('utf-8'))
-            out_dict_file.write(f"{term} {doc_freq} {total_offset} {postings_list_len}\n")
-            total_offset += postings_list_len
-            
-def copy_to_output_postings(aux_file_index, out_postings):
-    '''
-    Add skip pointers to the postings file and store it in the appropriate output location.
-    Skip intervals are the square root of the length of the postings list.
-    Based on this calculation, postings lists that contain at least 16 documents 
-    can benefit from skip pointers. Anything less would result in equal or more
-    work than simply parsing the list linearly. 
-    '''
-    with open(f"{AUXILIARY_POST}/p{aux_file_index}.txt", "r") as postings_file, open(out_postings, "w") as skips:
-        for line in postings_file:
-            postings_list = line.strip().split(',')
-            skipped = ""
-            skip_interval = 0
-            if len(postings_list) >= 16:
-                skip_interval = floor(sqrt(len(postings_list)))
-                
-            for i, docID in enumerate(postings_list):
-                skip_to = min(i + skip_interval, len(postings_list) - 1)
-                skipped += (f'({docID},{skip_to}) ')
-            
-            skips.write(skipped + '\n')
+    text:   every posting is written as a (docID, skip pointer index) tuple
+    binary: docIDs are written as blocks of variable byte encoded gaps, whose headers
+            replace skip pointers (see postings.py).
+            Terms that appear in at least BITMAP_DENSITY of the num_docs documents
+            are written as compressed bitmaps instead (see bitmap.py)
+    '''
+    if POSTINGS_FORMAT == 'binary' and len(postings_list) >= BITMAP_DENSITY * num_docs:
+        return encode_bitmap(postings_list), 'b'
+    if POSTINGS_FORMAT == 'binary':
+        return encode_block_postings(postings_list), 'l'
+
+    interval = skip_interval(len(postings_list))
+    skipped = ""
+    for i, docID in enumerate(postings_list):
+        skip_to = min(i + interval, len(postings_list) - 1)
+        skipped += (f'({docID},{skip_to}) ')
+    return (skipped + '\n').encode('utf-8'), 'l'
 
             
 input_directory = "/user/e/e1025440/nltk_data/corpora/reuters/training/"
@@ -336,7 +619,7 @@ output_file_dictionary = 'dictionary.txt'
 output_file_postings = 'postings.txt'
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:t:v')
+    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:t:vf:D:T:j:m:ax:Ms:')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -352,19 +635,44 @@ for o, a in opts:
         TEST_MODE = True        
     elif o == '-v': # verbose mode
         VERBOSE = True
+    elif o == '-f': # postings format
+        POSTINGS_FORMAT = a
+    elif o == '-D': # dictionary format
+        DICTIONARY_FORMAT = a
+    elif o == '-T': # tokenizer
+        TOKENIZER = a
+    elif o == '-j': # number of worker processes
+        NUM_WORKERS = int(a)
+    elif o == '-m': # memory budget in MB
+        MEMORY_BUDGET = float(a)
+    elif o == '-a': # add documents mode
+        INDEX_MODE = 'add'
+    elif o == '-x': # delete documents mode
+        INDEX_MODE = 'delete'
+        DELETED_DOCS_FILE = a
+    elif o == '-M': # merge segments mode
+        INDEX_MODE = 'merge'
+    elif o == '-s': # number of shards
+        NUM_SHARDS = int(a)
     else:
         assert False, "unhandled option"
 
-if input_directory == None or output_file_postings == None or output_file_dictionary == None:
+if input_directory == None or output_file_postings == None or output_file_dictionary == None or POSTINGS_FORMAT not in POSTINGS_FORMATS or DICTIONARY_FORMAT not in DICTIONARY_FORMATS or TOKENIZER not in TOKENIZERS:
     usage()
     sys.exit(2)
 
-if TEST_MODE:
-    MAX_BLOCK_SIZE = 350
-else:
-    MAX_BLOCK_SIZE = 3500
+if MEMORY_BUDGET == None:
+    MEMORY_BUDGET = 0.25 if TEST_MODE else 32
     
-CHUNK_SIZE = MAX_BLOCK_SIZE//2
+MAX_BLOCK_BYTES = int(MEMORY_BUDGET * 2**20)     # estimated bytes of memory of the blocks of all workers
+CHUNK_SIZE = MAX_BLOCK_BYTES//2                  # bytes of merged output buffered between disk-writes
 
 if __name__ == "__main__":
-    build_index(input_directory, output_file_dictionary, output_file_postings)
+    if INDEX_MODE == 'add':
+        add_documents(input_directory, output_file_dictionary, output_file_postings)
+    elif INDEX_MODE == 'delete':
+        delete_documents(output_file_dictionary, output_file_postings, DELETED_DOCS_FILE)
+    elif INDEX_MODE == 'merge':
+        merge_segments(output_file_dictionary, output_file_postings)
+    else:
+        build_index(input_directory, output_file_dictionary, output_file_postings)
@@ -0,0 +1,333 @@
+'''
+On-disk postings formats shared by index.py and search.py
+
+text:   each postings list is one line of "(docID,skip pointer) " tuples
+binary: the file starts with BINARY_MAGIC, followed by every postings list split into blocks
+        of POSTINGS_BLOCK_SIZE docIDs, all numbers being variable byte encoded:
+        - the number of docIDs of the list
+        - a header per block: the gap between its last docID and the last docID of the previous block,
+          and its length in bytes, from which the byte offset of every block is derived
+        - the blocks: the gaps between consecutive docIDs, starting from the last docID of the previous block
+        so that a block can be found from the headers and decoded on its own (see BlockPostings)
+        Files starting with LEGACY_BINARY_MAGIC store every postings list as a single run of gaps
+'''
+import mmap
+import os
+import sys
+
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import accumulate
+from math import ceil, floor, sqrt
+
+BINARY_MAGIC = b'BRP2'
+LEGACY_BINARY_MAGIC = b'BRP1'
+POSTINGS_FORMATS = ('binary', 'text')
+POSTINGS_BLOCK_SIZE = 128
+
+
+def skip_interval(length):
+    '''
+    Skip intervals are the square root of the length of the postings list.
+    Postings lists that contain less than 16 documents do not get skip pointers,
+    since skipping would be equal or more work than parsing the list linearly.
+    Because the skips are evenly spaced, they are fully determined by the list
+    length and are never stored alongside the docIDs.
+    '''
+    if length >= 16:
+        return floor(sqrt(length))
+    return 0
+
+def encode_vbyte(number):
+    '''
+    Variable byte encode a non-negative integer. Each byte holds 7 bits of the number,
+    and the high bit is set on the last byte to mark the end of the number.
+    e.g. 824 -> 00000110 10111000
+    '''
+    encoded = bytearray()
+    while True:
+        encoded.insert(0, number & 0x7f)
+        if number < 128:
+            break
+        number >>= 7
+    encoded[-1] |= 0x80
+    return bytes(encoded)
+
+def decode_vbyte(data):
+    '''
+    Decode a buffer of variable byte encoded integers into a list of integers
+    '''
+    numbers = []
+    number = 0
+    for byte in data:
+        if byte < 128:
+            number = (number << 7) | byte
+        else:
+            numbers.append((number << 7) | (byte & 0x7f))
+            number = 0
+    return numbers
+
+def decode_postings(data):
+    '''
+    Decode a gap and variable byte encoded postings list of a LEGACY_BINARY_MAGIC file back into its sorted docIDs
+    '''
+    return list(accumulate(decode_vbyte(data)))
+
+def encode_block_postings(doc_ids):
+    '''
+    Encode a sorted list of docIDs as blocks of POSTINGS_BLOCK_SIZE variable byte encoded gaps, with their headers
+    '''
+    headers = bytearray(encode_vbyte(len(doc_ids)))
+    blocks = bytearray()
+    previous_last = 0
+    for start in range(0, len(doc_ids), POSTINGS_BLOCK_SIZE):
+        block_doc_ids = doc_ids[start:start + POSTINGS_BLOCK_SIZE]
+        block = bytearray()
+        previous = previous_last
+        for doc_id in block_doc_ids:
+            block += encode_vbyte(doc_id - previous)
+            previous = doc_id
+        headers += encode_vbyte(block_doc_ids[-1] - previous_last) + encode_vbyte(len(block))
+        blocks += block
+        previous_last = block_doc_ids[-1]
+    return bytes(headers + blocks)
+
+def read_block_postings(data):
+    '''
+    Open a block postings list for lazy decoding, or decode it at once if it has a single block
+    '''
+    postings = BlockPostings(data)
+    if postings.num_blocks <= 1:
+        return postings.block(0) if postings.num_blocks else []
+    return postings
+
+def decode_block_postings(data):
+    '''
+    Decode a block postings list into its sorted docIDs
+    '''
+    return list(BlockPostings(data))
+
+def decode_text_postings(data):
+    '''
+    Decode a text postings list into its docIDs, dropping the stored skip pointers
+    e.g. (2,3) (3,10) (4,5) -> [2, 3, 4]
+    '''
+    return [int(posting[1:posting.index(b',')]) for posting in bytes(data).split()]
+
+
+class BlockPostings:
+    '''
+    Postings list in the blocked binary format that is decoded one block at a time, only when
+    one of its docIDs is needed. It behaves like a sorted list of docIDs (len, indexing, iteration,
+    membership), and the headers let intersections skip the blocks that cannot contain a match.
+    Only the last decoded block is kept, so that a list held by the PostingsCache never grows past its cached size.
+    '''
+    def __init__(self, data):
+        '''
+        Constructor
+        '''
+        # the encoded list is copied out of the memory-mapped file, so that it can outlive the map
+        self.data = bytes(data)
+        numbers = []
+        position = 0
+        number = 0
+        count = None
+        # the count and headers are the leading variable byte encoded numbers
+        while count is None or len(numbers) < 2 * ceil(count / POSTINGS_BLOCK_SIZE):
+            byte = self.data[position]
+            position += 1
+            if byte < 128:
+                number = (number << 7) | byte
+            else:
+                number = (number << 7) | (byte & 0x7f)
+                if count is None:
+                    count = number
+                else:
+                    numbers.append(number)
+                number = 0
+        self.count = count
+        self.num_blocks = len(numbers) // 2
+        self.lasts = list(accumulate(numbers[0::2]))            # last docID of every block
+        self.offsets = list(accumulate(numbers[1::2], initial=position))    # byte offset of every block
+        self.last_block = (None, None)                          # (block index, decoded docIDs) of the last block
+
+    def block(self, block_index):
+        '''
+        return the decoded docIDs of a block
+        '''
+        # the index and docIDs are read and replaced together, so that threads sharing the list never mix them up
+        last_index, decoded = self.last_block
+        if last_index != block_index:
+            previous = self.lasts[block_index - 1] if block_index else 0
+            gaps = decode_vbyte(self.data[self.offsets[block_index]:self.offsets[block_index + 1]])
+            gaps[0] += previous
+            decoded = list(accumulate(gaps))
+            self.last_block = (block_index, decoded)
+        return decoded
+
+    def seek(self, doc_id, block_index=0):
+        '''
+        return the index of the first block, at or after block_index, that may contain doc_id
+        or any larger docID, and num_blocks if there is none. Only the headers are read
+        '''
+        return bisect_left(self.lasts, doc_id, block_index)
+
+    def block_contains(self, block_index, doc_id):
+        decoded = self.block(block_index)
+        index = bisect_left(decoded, doc_id)
+        return index < len(decoded) and decoded[index] == doc_id
+
+    def intersect(self, doc_ids):
+        '''
+        return the docIDs of the sorted doc_ids that are in the postings list,
+        decoding only the blocks where they would be
+        '''
+        answer = []
+        block_index = 0
+        for doc_id in doc_ids:
+            block_index = self.seek(doc_id, block_index)
+            if block_index == self.num_blocks:
+                break
+            if self.block_contains(block_index, doc_id):
+                answer.append(doc_id)
+        return answer
+
+    def difference(self, doc_ids):
+        '''
+        return the docIDs of the sorted doc_ids that are not in the postings list,
+        decoding only the blocks where they would be
+        '''
+        answer = []
+        block_index = 0
+        for doc_id in doc_ids:
+            block_index = self.seek(doc_id, block_index)
+            if block_index == self.num_blocks or not self.block_contains(block_index, doc_id):
+                answer.append(doc_id)
+        return answer
+
+    def __contains__(self, doc_id):
+        block_index = self.seek(doc_id)
+        return block_index < self.num_blocks and self.block_contains(block_index, doc_id)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self.count
+        return self.block(index // POSTINGS_BLOCK_SIZE)[index % POSTINGS_BLOCK_SIZE]
+
+    def __iter__(self):
+        for block_index in range(self.num_blocks):
+            yield from self.block(block_index)
+
+    def __sizeof__(self):
+        # a full decoded block is always counted, so that the size does not change as blocks are decoded
+        return (object.__sizeof__(self) + sys.getsizeof(self.data) + 2 * sys.getsizeof(self.lasts)
+                + postings_size([0] * min(self.count, POSTINGS_BLOCK_SIZE)))
+
+
+class PostingsReader:
+    '''
+    Opens the postings file once and memory-maps it, so that reading the postings list
+    of a term is a zero-copy slice of the mapped file instead of an open, seek and read.
+    '''
+    def __init__(self, postings_file):
+        '''
+        Constructor
+        '''
+        self.file = open(postings_file, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:   # an empty file cannot be memory-mapped
+            self.buffer = b''
+        self.view = memoryview(self.buffer)
+        # the binary postings format is identified by its header, otherwise the file is in the text format
+        self.blocked = self.view[:len(BINARY_MAGIC)] == BINARY_MAGIC
+        self.binary = self.blocked or self.view[:len(LEGACY_BINARY_MAGIC)] == LEGACY_BINARY_MAGIC
+
+    def read(self, pointer, num_bytes):
+        '''
+        return a memoryview of the num_bytes bytes of the postings file starting at pointer
+        '''
+        return self.view[pointer:pointer + num_bytes]
+
+    def close(self):
+        '''
+        release the memory map and close the postings file
+        '''
+        self.view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def postings_size(postings):
+    '''
+    Estimate the number of bytes of memory used by a decoded postings list,
+    counting the list itself and one int object per docID
+    '''
+    if not isinstance(postings, list):
+        return sys.getsizeof(postings)      # e.g. a Bitmap, which reports the size of its bits
+    return sys.getsizeof(postings) + len(postings) * sys.getsizeof(2**30)
+
+class PostingsCache:
+    '''
+    Least recently used cache of decoded postings lists keyed by term, or by any other hashable key.
+    Entries are evicted once the estimated size of all cached lists exceeds max_bytes,
+    and the cache keeps count of its hits and misses to help tune max_bytes.
+    '''
+    def __init__(self, max_bytes, name="postings cache"):
+        '''
+        Constructor
+        '''
+        self.name = name
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()      # term -> (postings, size in bytes), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, term):
+        '''
+        return the cached postings list of term, or None if it is not cached
+        '''
+        entry = self.entries.get(term)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(term)
+        return entry[0]
+
+    def put(self, term, postings):
+        '''
+        cache the postings list of term, evicting the least recently used lists until it fits.
+        Lists larger than the whole budget are not cached.
+        '''
+        size = postings_size(postings)
+        if size > self.max_bytes:
+            return
+        if term in self.entries:
+            self.current_bytes -= self.entries.pop(term)[1]
+        while self.current_bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        self.entries[term] = (postings, size)
+        self.current_bytes += size
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f"{self.name}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.evictions} evictions, {len(self.entries)} lists using {self.current_bytes} of {self.max_bytes} bytes")
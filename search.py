@@ -1,135 +1,786 @@
 #!/usr/bin/python3
-import re
-import nltk
 import sys
 import getopt
 import collections
+import heapq
+import io
+import json
+import multiprocessing
 import os
+import threading
+import time
 
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager, nullcontext
+from heapq import merge
+from itertools import compress, islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from analysis import Analyzer, read_tokenizer
+from bitmap import Bitmap, decode_bitmap
+from dictionary import BinaryDictionary, load_dictionary
+from postings import (BlockPostings, PostingsCache, PostingsReader, decode_postings, decode_text_postings, postings_size,
+                      read_block_postings, skip_interval)
+from segments import list_segments, manifest_file, read_tombstones, tombstone_file
+from shards import list_shards, shard_manifest_file
+from vectorized import (and_arrays, and_not_arrays, as_array, complement, decode_postings_array, intersect_arrays, is_array, is_long,
+                        member_mask, or_arrays, union_arrays, use_arrays)
+from wildcard import MAX_EXPANSIONS, WILDCARD_PATTERN, expand_wildcard, is_wildcard, read_kgram_index
+
+OUTPUT_CHUNK = 4096                 # docIDs formatted and written at a time
+OUTPUT_BUFFER_SIZE = 2**20          # bytes of the results file buffered between disk-writes
+PROBE_CHUNK = 128                   # docIDs of a lazy AND probed at once in an array operand, see probe_iter
+REFRESH_INTERVAL = 1.0              # seconds between two checks of the search server for changes of the index
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results -c postings-cache-size-in-MB (optional, default 32) -S port (optional, serve queries over HTTP on localhost instead) -t (optional flag to trace the statistics of every query) -j number-of-worker-processes (optional, default 1) -w max-terms-per-wildcard (optional, default 1024) -r result-cache-size-in-MB (optional, default 16) -n max-results-per-query (optional, default all) -s results-to-skip (optional, default 0)")
 
-def run_search(dict_file, postings_file, queries_file, results_file):
+def run_search(dict_file, postings_file, queries_file, results_file, cache_size=32, trace=False, num_workers=1,
+               max_expansions=MAX_EXPANSIONS, result_cache_size=16, limit=None, offset=0):
     """
     using the given dictionary file and postings file,
-    perform searching on the given queries file and output the results to a file
+    perform searching on the given queries file and output the results to a file.
+    Decoded postings lists are shared across queries in an LRU cache of cache_size MB,
+    and the results of the canonical subexpressions of the queries in an LRU cache of result_cache_size MB.
+    With trace, the statistics of every query are written to results_file.trace.jsonl (see QueryTracer).
+    With more than one worker, the queries are evaluated by a pool of processes (see search_parallel).
+    The queries of a sharded index are evaluated on all its shards in parallel instead, by num_workers processes
+    per shard (see search_sharded).
+    Wildcard terms are expanded to at most max_expansions terms.
+    Only the page of up to limit docIDs after the first offset docIDs of every result is written,
+    and the results are streamed to results_file through a buffer of OUTPUT_BUFFER_SIZE bytes
     """
     print('running search on the queries...')
 
-    # clear the out_file
-    open(results_file, 'w').close()
+    tracer = QueryTracer(f"{results_file}.trace.jsonl") if trace else None
 
-    stemmer = nltk.stem.porter.PorterStemmer()
-    operators_prio = {"AND": 2, "OR": 1, "NOT": 3, "(": 0, ")": 0}
+    # Read the queries_file line by line, and write the result of every query to the results_file
+    shards = list_shards(dict_file, postings_file)
+    with open(queries_file) as file, open(results_file, "w", buffering=OUTPUT_BUFFER_SIZE) as result_f:
+        if len(shards) > 1:
+            for result in search_sharded(shards, file, cache_size, num_workers, tracer, max_expansions=max_expansions,
+                                         result_cache_size=result_cache_size, limit=limit, offset=offset):
+                result_f.write(result)
+        elif num_workers > 1:
+            for result in search_parallel(dict_file, postings_file, file, cache_size, num_workers, tracer, max_expansions=max_expansions,
+                                          result_cache_size=result_cache_size, limit=limit, offset=offset):
+                result_f.write(result)
+        else:
+            searcher = Searcher(dict_file, postings_file, cache_size, max_expansions, result_cache_size, limit, offset)
+            searcher.write_lines(file, result_f, tracer)
+            searcher.close()
+            print(searcher.index.postings_cache)
+            print(searcher.index.result_cache)
+            print(searcher.analyzer)
+    if tracer is not None:
+        tracer.close()
+
+
+# Searcher of a worker process of search_parallel, loaded once per process by init_search_worker
+worker_searcher = None
+
+def init_search_worker(dict_file, postings_file, cache_size, max_expansions=MAX_EXPANSIONS, result_cache_size=16,
+                       limit=None, offset=0):
+    global worker_searcher
+    worker_searcher = Searcher(dict_file, postings_file, cache_size, max_expansions, result_cache_size, limit, offset)
+
+def search_worker(task):
+    """
+    return the output of a (query, trace) task evaluated by the Searcher of the worker, and its QueryTrace if traced
+    """
+    line, trace = task
+    if not trace:
+        return worker_searcher.search(line), None
+    query_trace = QueryTrace(line)
+    return worker_searcher.search(line, query_trace), query_trace
+
+def search_parallel(dict_file, postings_file, lines, cache_size=32, num_workers=2, tracer=None, chunk_size=256,
+                    max_expansions=MAX_EXPANSIONS, result_cache_size=16, limit=None, offset=0):
+    """
+    Yield the output of every line of queries, in order, like Searcher.write_lines,
+    evaluating the queries in a pool of num_workers processes.
+    Every worker opens the index once, and the postings and dictionary files are memory-mapped,
+    so the workers share the pages of the index instead of each reading a copy.
+    Queries are sent to the workers chunk_size at a time, and the results are yielded in the original order
+    """
+    stopped = []
+    with multiprocessing.Pool(num_workers, initializer=init_search_worker,
+                              initargs=(dict_file, postings_file, cache_size, max_expansions, result_cache_size, limit, offset)) as pool:
+        tasks = ((line, tracer is not None) for line in query_lines(lines, stopped))
+        for result, query_trace in pool.imap(search_worker, tasks, chunksize=chunk_size):
+            if tracer is not None:
+                tracer.write(query_trace)
+            yield result
+    if stopped:
+        yield "\n"
+
+def search_sharded(shards, lines, cache_size=32, num_workers=1, tracer=None, chunk_size=256,
+                   max_expansions=MAX_EXPANSIONS, result_cache_size=16, limit=None, offset=0):
+    """
+    Yield the output of every line of queries, in order, like Searcher.write_lines,
+    evaluating every query on all the (dictionary file, postings file) shards of an index in parallel (see shards.py).
+    Every shard is searched by its own pool of num_workers processes, a local stand-in for a remote search node
+    that only opens the index of its shard. Shards hold increasing and disjoint ranges of docIDs, so the output of a
+    query is the concatenation of its outputs on every shard, in shard order (see merge_shard_outputs),
+    and a NOT is only complemented over the docIDs of each shard.
+    Queries are sent to all the shards chunk_size at a time, with up to 2 chunks in flight.
+    With a limit, every shard returns its first offset + limit docIDs, and the page is cut from their concatenation.
+    With a QueryTracer, the trace of every query on every shard is written
+    """
+    stopped = []
+
+    def chunks():
+        chunk = []
+        for line in query_lines(lines, stopped):
+            chunk.append((line, tracer is not None))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def gather(shard_results):
+        for shard_outputs in zip(*(result.get() for result in shard_results)):
+            if tracer is not None:
+                for shard, (_, query_trace) in enumerate(shard_outputs):
+                    query_trace.shard = shard
+                    tracer.write(query_trace)
+            yield merge_shard_outputs([output for output, _ in shard_outputs], offset, limit)
+
+    with ExitStack() as stack:
+        pools = [stack.enter_context(multiprocessing.Pool(num_workers, initializer=init_search_worker,
+                                                          initargs=(shard_dict, shard_postings, cache_size, max_expansions, result_cache_size,
+                                                                    None if limit is None else offset + limit)))
+                 for shard_dict, shard_postings in shards]
+        pending = collections.deque()
+        for chunk in chunks():
+            if len(pending) == 2:
+                yield from gather(pending.popleft())
+            pending.append([pool.map_async(search_worker, chunk) for pool in pools])
+        while pending:
+            yield from gather(pending.popleft())
+    if stopped:
+        yield "\n"
+
+def merge_shard_outputs(outputs, offset=0, limit=None):
+    """
+    return the output of a query from its outputs on every shard, in shard order.
+    Invalid queries are invalid on every shard, and the docIDs of the shards are concatenated,
+    e.g. "1 5\n", "\n", "12\n" -> "1 5 12\n", then cut to the page of up to limit docIDs after the first offset docIDs
+    """
+    if not outputs[0].endswith("\n") or outputs[0] == "INVALID QUERY\n":
+        return outputs[0]
+    output = " ".join(output[:-1] for output in outputs if output != "\n")
+    if offset == 0 and limit is None:
+        return output + "\n"
+    return " ".join(output.split()[offset:None if limit is None else offset + limit]) + "\n"
+
+def query_lines(lines, stopped):
+    """
+    yield the lines of queries up to the first line that is too long or empty, which is appended to stopped
+    """
+    for line in lines:
+        # if length of the query exceeds the max query length, no result will be logged
+        # or if the query is empty, no result will be logged
+        if len(line) > Searcher.max_query_len or len(line) == 0:
+            stopped.append(line)
+            return
+        yield line
+
+
+def file_version(file):
+    """
+    return the (inode, modification time, size) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def index_generation(dict_file, postings_file):
+    """
+    return the versions of the files that change when the index changes: the shard manifest, and the dictionary,
+    segment manifest and tombstones of every shard. Manifests and tombstones are replaced by atomic renames,
+    so every add, delete or merge of index.py changes the generation
+    """
+    files = [shard_manifest_file(dict_file)]
+    for shard_dict, _ in list_shards(dict_file, postings_file):
+        files += [shard_dict, manifest_file(shard_dict), tombstone_file(shard_dict)]
+    return tuple(file_version(file) for file in files)
+
+
+class SearchIndex:
+    """
+    The index as it was when it was opened: the dictionary and memory-mapped postings file of every segment
+    of every shard, the list of all docIDs, the tombstones, and the postings cache and result cache of these segments.
+    A Searcher swaps in a new SearchIndex when the index changes on disk (see Searcher.refresh)
+    """
+    def __init__(self, dict_file, postings_file, cache_size=32, max_expansions=MAX_EXPANSIONS, result_cache_size=16):
+        # read before the segments, so that a change made while they are loaded is picked up by the next refresh
+        self.generation = index_generation(dict_file, postings_file)
+
+        # load the dictionary of every segment of the index into memory,
+        # and open and memory-map their postings files once for all queries.
+        # The shards of a sharded index hold disjoint docIDs like segments, so all their segments are searched at once
+        shards = list_shards(dict_file, postings_file)
+        self.segments = []
+        try:
+            for shard_dict, shard_postings in shards:
+                for segment_dict, segment_postings in list_segments(shard_dict, shard_postings):
+                    self.segments.append(Segment(segment_dict, segment_postings))
+        except OSError:
+            # e.g. a segment removed by a merge after the manifest was read
+            self.close()
+            raise
+        tombstones = 0
+        for shard_dict, _ in shards:
+            tombstones |= read_tombstones(shard_dict).bits
+        self.tombstones = Bitmap(tombstones)
+
+        # create a bitmap of all docIDs used for the NOT operation, without the deleted docIDs
+        all_bits = 0
+        for segment in self.segments:
+            all_bits |= segment.universe.bits
+        self.all_postings = Bitmap(all_bits & ~self.tombstones.bits)
+
+        self.postings_cache = PostingsCache(int(cache_size * 1024 * 1024))
+        # the results of canonical subexpressions, shared by all the queries of a batch (see canonicalize)
+        self.result_cache = PostingsCache(int(result_cache_size * 1024 * 1024), "result cache")
+        self.cache_lock = threading.Lock()      # the caches are shared by the threads of the search server
+        self.max_expansions = max_expansions
+        # the queries evaluated on this index, and whether a newer index replaced it, see Searcher.refresh
+        self.users = 0
+        self.retired = False
+    def fetch_posting(self, term, trace=None):
+        """
+        return the decoded postings list of term, or an empty list if the term is not indexed
+        """
+        start_time = time.perf_counter()
+        num_bytes = 0
+        # reuse the decoded posting if the term was seen in a recent query
+        with self.cache_lock:
+            answer = self.postings_cache.get(term)
+        cached = answer is not None
+        if answer is None:
+            # segments hold disjoint docIDs, so the posting of a term is the union of its segment postings
+            entries = [(segment, segment.dictionary.get(term)) for segment in self.segments]
+            answer = union([segment.get_posting(entry) for segment, entry in entries if entry is not None])
+            num_bytes = sum(entry[1] for _, entry in entries if entry is not None)
+            with self.cache_lock:
+                self.postings_cache.put(term, answer)
+        if trace is not None:
+            trace.record_fetch(term, cached, num_bytes, len(answer), time.perf_counter() - start_time)
+        return answer
+
+    def expand(self, pattern):
+        """
+        return the terms matching a wildcard pattern in any segment, in alphabetical order,
+        and whether they were capped at max_expansions terms
+        """
+        terms = set()
+        for segment in self.segments:
+            terms.update(segment.expand(pattern, self.max_expansions + 1))
+        terms = sorted(terms)
+        return terms[:self.max_expansions], len(terms) > self.max_expansions
+
+    def expand_wildcards(self, node, trace=None):
+        """
+        expand the wildcard terms of an operator tree into the terms they match
+        """
+        if node.op == "WILDCARD":
+            node.terms, capped = self.expand(node.term)
+            if trace is not None:
+                trace.record_expansion(node.term, len(node.terms), capped)
+        for child in node.children:
+            self.expand_wildcards(child, trace)
+
+    def cached_result(self, key):
+        with self.cache_lock:
+            return self.result_cache.get(key)
+
+    def cache_result(self, key, result):
+        with self.cache_lock:
+            self.result_cache.put(key, result)
+
+    def doc_freq(self, term):
+        entries = [segment.dictionary.get(term) for segment in self.segments]
+        return sum(entry[2] for entry in entries if entry is not None)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class Searcher:
+    """
+    Index loaded once for any number of queries (see SearchIndex), with the analyzer of its queries and their latency.
+    Used by run_search for a file of queries and by the search server (see serve_search)
+    """
     max_query_len = 1024
+    operators_prio = {"AND": 2, "OR": 1, "NOT": 3, "(": 0, ")": 0}
+
+    def __init__(self, dict_file, postings_file, cache_size=32, max_expansions=MAX_EXPANSIONS, result_cache_size=16,
+                 limit=None, offset=0):
+        # queries are analyzed with the tokenizer the index was built with
+        self.analyzer = Analyzer(read_tokenizer(dict_file))
+        self.dict_file = dict_file
+        self.postings_file = postings_file
+        self.cache_size = cache_size
+        self.max_expansions = max_expansions
+        self.result_cache_size = result_cache_size
+        self.index = SearchIndex(dict_file, postings_file, cache_size, max_expansions, result_cache_size)
+        self.index_lock = threading.Lock()      # guards the swap of the index and the count of its queries
+        self.refreshed = time.monotonic()
+        self.refreshing = False
+        self.stats = LatencyStats()
+        # the default page of results of every query, see write
+        self.limit = limit
+        self.offset = offset
+
+    def refresh(self):
+        """
+        Swap in a new SearchIndex if the index changed on disk since the current one was opened: segments added
+        by index.py -a, documents deleted with -x, or segments merged in the background. The files are checked
+        at most once every REFRESH_INTERVAL seconds. Queries already running finish on the index they started on,
+        which is closed after the last of them, releasing the files of merged segments.
+        Return whether the index was swapped
+        """
+        with self.index_lock:
+            if self.refreshing or time.monotonic() - self.refreshed < REFRESH_INTERVAL:
+                return False
+            self.refreshing = True
+        try:
+            if index_generation(self.dict_file, self.postings_file) == self.index.generation:
+                return False
+            index = SearchIndex(self.dict_file, self.postings_file, self.cache_size, self.max_expansions,
+                                self.result_cache_size)
+        except OSError:
+            # the index is being rewritten, e.g. a merged segment was removed after the manifest was read,
+            # so the current index is kept until the next check
+            return False
+        finally:
+            with self.index_lock:
+                self.refreshed = time.monotonic()
+                self.refreshing = False
+        with self.index_lock:
+            old_index, self.index = self.index, index
+            old_index.retired = True
+        self.release_index(old_index, 0)
+        return True
 
-    # load dictionary into memory
-    dictionary = {}
-    with open(dict_file, 'r') as dic_file:
-        all_postings_str = dic_file.readline()          # first line in dict_file contains all docIDs
-        for line in dic_file:
-            term, doc_freq, pointer, num_bytes = line.split(" ")   # omitting doc freq 
-            dictionary[term] = [int(pointer), int(num_bytes)]
-
-    # create an all posting tuple list used to NOT operation
-    all_postings = all_postings_str.strip().split(" ")
-    all_postings = [int(x) for x in all_postings]
-    all_postings = list(zip(all_postings, all_postings))
-
-    result_f = open(results_file, "a")
-
-    # Read the queries_file line by line
-    with open(queries_file) as file:
-        terms = dictionary.keys()
-        for line in file:
+    def acquire_index(self):
+        """
+        return the current index, which stays open until it is released
+        """
+        with self.index_lock:
+            self.index.users += 1
+            return self.index
+
+    def release_index(self, index, users=1):
+        """
+        release an index acquired by acquire_index, and close it if it was replaced and this was its last query
+        """
+        with self.index_lock:
+            index.users -= users
+            close = index.retired and index.users == 0
+        if close:
+            index.close()
+
+    def write_lines(self, lines, out, tracer=None):
+        """
+        write the output of every line of queries to out, in order (see write).
+        With a QueryTracer, the statistics of every query are traced
+        """
+        for line in lines:
             # if length of the query exceeds the max query length, no result will be logged
             # or if the query is empty, no result will be logged
-            if len(line) > max_query_len or len(line) == 0:
-                result_f.write("\n")
+            if len(line) > self.max_query_len or len(line) == 0:
+                out.write("\n")
                 break
+            if tracer is None:
+                self.write(line, out)
+            else:
+                trace = QueryTrace(line)
+                self.write(line, out, trace)
+                tracer.write(trace)
+
+    def search(self, line, trace=None, page=None):
+        """
+        return the output of a single query as a string (see write)
+        """
+        out = io.StringIO()
+        self.write(line, out, trace, page)
+        return out.getvalue()
+
+    def write(self, line, out, trace=None, page=None):
+        """
+        write the output of a single query to out: its docIDs followed by a new line, "INVALID QUERY" followed
+        by a new line, or nothing if the query doesn't reduce to a single tree.
+        Only the docIDs of the page are written, an (offset, limit) pair that defaults to the offset and limit
+        of the Searcher, where a limit of None means every docID after the offset
+        """
+        start_time = time.perf_counter()
+        # the query is evaluated on a single index, even if a newer one is swapped in meanwhile
+        index = self.acquire_index()
+        try:
+            self.evaluate(line, out, index, trace, page or (self.offset, self.limit))
+        finally:
+            self.release_index(index)
+            seconds = time.perf_counter() - start_time
+            self.stats.record(seconds)
+            if trace is not None:
+                trace.seconds = seconds
+
+    def evaluate(self, line, out, index, trace=None, page=(0, None)):
+        phase = trace.phase if trace is not None else lambda name: nullcontext()
+        fetch_posting = index.fetch_posting if trace is None else lambda term: index.fetch_posting(term, trace)
+
+        # obtain the query in Reverse Polish notation, then build its operator tree
+        try:
+            with phase("parse"):
+                shunting_yard_output = parse_shunting_yard(line, self.operators_prio, self.analyzer)
+            with phase("build"):
+                query_tree = build_query_tree(shunting_yard_output)
+        except InvalidQueryError:
+            out.write("INVALID QUERY\n")
+            return
+
+        # if the query doesn't reduce to a single tree, that means the query was invalid
+        if query_tree is None:
+            return
+
+        # rewrite the tree into its canonical form, so that equivalent subexpressions share their results
+        with phase("rewrite"):
+            query_tree = canonicalize(query_tree)
 
-            # obtain the query in Reverse Polish notation
-            shunting_yard_output = parse_shunting_yard(line, operators_prio, stemmer)
-
-            queue = collections.deque(shunting_yard_output)
-            result_stack = []
-            while queue:
-                answer = []
-                # evaluate the transformation from the left
-                token = queue.popleft()
-                # perform AND operator on the left operand and right operand 
-                if token == "AND":
-                    if len(result_stack) > 1:
-                        right = result_stack.pop()
-                        left = result_stack.pop()
-                        answer = and_op(left, right)
-                    else:
-                        result_f.write("INVALID QUERY\n")
-                        result_stack = []
-                        break
-                # perform NOT operator on the right operand 
-                elif token == "NOT":
-                    if len(result_stack) > 0:
-                        right = result_stack.pop()
-                        answer = not_op(right, all_postings)
-                    else:
-                        result_f.write("INVALID QUERY\n")
-                        result_stack = []
-                        break
-                # perform OR operator on the left operand and right operand 
-                elif token == "OR":
-                    if len(result_stack) > 1:
-                        right = result_stack.pop()
-                        left = result_stack.pop()
-                        answer = or_op(left, right)
-                    else:
-                        result_f.write("INVALID QUERY\n")
-                        result_stack = []
-                        break
-                # if token is a term, not an operator
-                else:
-                    if token in terms:
-                        # obtain the pointer to the posting
-                        pointer = dictionary[token][0]
-                        num_bytes = dictionary[token][1]
-                        # obtain the corresponding posting pointed by the pointer
-                        with open(postings_file) as postings_f:
-                            postings_f.seek(pointer, 0)
-                            answer = get_posting(postings_f.read(num_bytes))
-
-                result_stack.append(answer)
-
-            # if result stack doesn't have 1 item, that means the query was invalid
-            if len(result_stack) == 1:
-                # write result to results_file
-                result_list = result_stack.pop()
-                # if no document found
-                if result_list == None:
-                    result_f.write("\n")
-                else:
-                    result_str = str([i[0] for i in result_list])
-                    result = re.sub("\[|\]|,", "", result_str)
-                    result_f.write(result+"\n")
-    result_f.close()
-  
-
-def parse_shunting_yard(line, operators_prio, stemmer):
+        with phase("expand"):
+            index.expand_wildcards(query_tree, trace)
+
+        # reorder the operands by their estimated sizes, then evaluate the plan
+        with phase("plan"):
+            query_plan = plan_query(query_tree, index.doc_freq, len(index.all_postings))
+        offset, limit = page
+        if limit is None:
+            # every docID is needed, so the plan is evaluated by the operators that materialize their results
+            with phase("evaluate"):
+                result_list = evaluate_query(query_plan, fetch_posting, index.all_postings, trace, index)
+            with phase("output"):
+                # deleted docIDs are removed from the result, complements already exclude them
+                if index.tombstones and not isinstance(result_list, Complement):
+                    result_list = and_not_op(result_list, index.tombstones)
+                # a long bitmap is converted to an array at once (see vectorized.py)
+                if isinstance(result_list, Bitmap) and is_long(len(result_list)):
+                    result_list = as_array(result_list)
+                write_docIDs(islice(iterate_posting(result_list), offset, None), out)
+        else:
+            # the docIDs of the page are pulled through lazy operators, which stop evaluating once the page is written
+            with phase("output"):
+                docIDs = iterate_query(query_plan, fetch_posting, index.all_postings, index)
+                if index.tombstones:
+                    docIDs = (docID for docID in docIDs if docID not in index.tombstones)
+                write_docIDs(islice(docIDs, offset, offset + limit), out)
+
+    def close(self):
+        self.index.close()
+
+
+class LatencyStats:
+    """
+    Thread-safe latency and throughput counters of the queries answered by a Searcher.
+    Percentiles are computed over the last window queries
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.queries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def record(self, seconds):
+        with self.lock:
+            self.queries += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.recent.append(seconds)
+
+    def snapshot(self):
+        """
+        return the counters as a dict, with latencies in milliseconds
+        """
+        with self.lock:
+            recent = sorted(self.recent)
+            uptime = time.time() - self.start_time
+            percentile = lambda p: recent[min(int(p * len(recent)), len(recent) - 1)] * 1000 if recent else 0.0
+            return {
+                "queries": self.queries,
+                "uptime_seconds": round(uptime, 3),
+                "queries_per_second": round(self.queries / uptime, 3) if uptime else 0.0,
+                "mean_ms": round(self.total_seconds / self.queries * 1000, 3) if self.queries else 0.0,
+                "p50_ms": round(percentile(0.50), 3),
+                "p95_ms": round(percentile(0.95), 3),
+                "p99_ms": round(percentile(0.99), 3),
+                "max_ms": round(self.max_seconds * 1000, 3),
+            }
+
+
+class QueryTrace:
+    """
+    Statistics of a single query, recorded when search.py runs with -t:
+    - the wall time of every phase: parse (tokenize, stem and shunting yard), build (operator tree),
+      rewrite (canonical form), expand (wildcard terms), plan, evaluate (including fetch, the postings I/O and decoding), and output (which includes lazy NOTs)
+    - every term fetched, whether its posting was cached, the postings bytes read and the posting size
+    - every operator with the sizes of its operands and result (the size of a lazy Complement is
+      the number of docIDs it yields)
+    - the number of skip pointers followed by and_op
+    - every wildcard term, the number of terms it was expanded to and whether they were capped
+    - the number of subexpressions whose result was reused from the result cache
+    With a limit (-n), the query is evaluated by lazy operators while its page is written, so the whole evaluation
+    is timed as output and its operators are not recorded
+    """
+    def __init__(self, query):
+        self.query = query.strip()
+        self.seconds = 0.0
+        self.phases = {}
+        self.fetches = []
+        self.operators = []
+        self.expansions = []
+        self.skips = 0
+        self.reused = 0
+        self.shard = None           # the shard the query was evaluated on, see search_sharded
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start_time
+
+    def record_fetch(self, term, cached, num_bytes, size, seconds):
+        self.phases["fetch"] = self.phases.get("fetch", 0.0) + seconds
+        self.fetches.append({"term": term, "cached": cached, "bytes": num_bytes, "size": size})
+
+    def record_expansion(self, pattern, num_terms, capped):
+        self.expansions.append({"pattern": pattern, "terms": num_terms, "capped": capped})
+
+    def record_operator(self, op, operands, result):
+        self.operators.append({"op": op, "inputs": [operand_size(operand) for operand in operands], "output": operand_size(result)})
+
+    def to_dict(self):
+        trace = {
+            "query": self.query,
+            "ms": round(self.seconds * 1000, 3),
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            "postings_bytes": sum(fetch["bytes"] for fetch in self.fetches),
+            "skips": self.skips,
+            "reused": self.reused,
+            "fetches": self.fetches,
+            "operators": self.operators,
+            "expansions": self.expansions,
+        }
+        if self.shard is not None:
+            trace["shard"] = self.shard
+        return trace
+
+
+class QueryTracer:
+    """
+    Writes the QueryTrace of every query as a line of JSON to trace_file,
+    and prints a summary of all queries when closed
+    """
+    def __init__(self, trace_file):
+        self.file = open(trace_file, "w")
+        self.queries = 0
+        self.seconds = 0.0
+        self.phases = collections.Counter()
+        self.postings_bytes = 0
+        self.skips = 0
+        self.reused = 0
+        self.slowest = []           # heap of the (seconds, query) of the slowest queries
+
+    def write(self, trace):
+        self.file.write(json.dumps(trace.to_dict()) + "\n")
+        self.queries += 1
+        self.seconds += trace.seconds
+        self.phases.update(trace.phases)
+        self.postings_bytes += sum(fetch["bytes"] for fetch in trace.fetches)
+        self.skips += trace.skips
+        self.reused += trace.reused
+        heapq.heappush(self.slowest, (trace.seconds, trace.query))
+        if len(self.slowest) > 5:
+            heapq.heappop(self.slowest)
+
+    def summary(self):
+        return {
+            "queries": self.queries,
+            "total_ms": round(self.seconds * 1000, 3),
+            "mean_ms": round(self.seconds / self.queries * 1000, 3) if self.queries else 0.0,
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            "postings_bytes": self.postings_bytes,
+            "skips": self.skips,
+            "reused": self.reused,
+            "slowest": [{"query": query, "ms": round(seconds * 1000, 3)} for seconds, query in sorted(self.slowest, reverse=True)],
+        }
+
+    def close(self):
+        self.file.close()
+        print(json.dumps(self.summary(), indent=2))
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the search server:
+        GET /search?q=query     the output of a single query, or of a page of it with &offset=N&limit=N
+        POST /search            the output of every line of the request body, exactly as run_search writes it
+        GET /stats              the latency and throughput counters and the postings and stem cache statistics, as JSON
+    Every request first picks up the changes made to the index since it was loaded (see Searcher.refresh)
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.searcher.refresh()
+        if url.path == "/search":
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0]
+            try:
+                offset = int(params["offset"][0]) if "offset" in params else self.server.searcher.offset
+                limit = int(params["limit"][0]) if "limit" in params else self.server.searcher.limit
+            except ValueError:
+                self.send_error(400, "offset and limit must be integers")
+                return
+            if offset < 0 or (limit is not None and limit < 0):
+                self.send_error(400, "offset and limit must not be negative")
+                return
+            self.reply(self.server.searcher.search(query, page=(offset, limit)))
+        elif url.path == "/stats":
+            stats = self.server.searcher.stats.snapshot()
+            index = self.server.searcher.index
+            with index.cache_lock:
+                stats["postings_cache"] = str(index.postings_cache)
+                stats["result_cache"] = str(index.result_cache)
+            stats["stem_cache"] = str(self.server.searcher.analyzer)
+            self.reply(json.dumps(stats) + "\n", "application/json")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/search":
+            self.send_error(404)
+            return
+        self.server.searcher.refresh()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        # the body is split into lines the same way as the queries file is read
+        lines = io.StringIO(body, newline=None)
+        out = io.StringIO()
+        self.server.searcher.write_lines(lines, out)
+        self.reply(out.getvalue())
+
+    def reply(self, text, content_type="text/plain"):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass            # the counters of /stats replace the per-request log
+
+
+def serve_search(dict_file, postings_file, port, cache_size=32, max_expansions=MAX_EXPANSIONS, result_cache_size=16,
+                 limit=None, offset=0):
+    """
+    Load the index once and answer queries over HTTP on localhost:port until interrupted,
+    with one thread per client connection. Segments added, documents deleted and segments merged by index.py
+    are picked up without a restart (see Searcher.refresh). See SearchRequestHandler and search_client.py
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), SearchRequestHandler)
+    server.searcher = Searcher(dict_file, postings_file, cache_size, max_expansions, result_cache_size, limit, offset)
+    print(f"serving search on http://127.0.0.1:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.searcher.close()
+        print(json.dumps(server.searcher.stats.snapshot()))
+        print(server.searcher.index.postings_cache)
+        print(server.searcher.index.result_cache)
+        print(server.searcher.analyzer)
+
+
+class Segment:
+    """
+    Dictionary and memory-mapped postings file of one segment of the index (see segments.py).
+    A binary dictionary is memory-mapped and searched in place, a text dictionary is loaded (see dictionary.py)
+    """
+    def __init__(self, dict_file, postings_file):
+        self.dict_file = dict_file
+        self.universe, self.dictionary = load_dictionary(dict_file)
+        self.postings_reader = PostingsReader(postings_file)
+        # the sorted term array and k-gram index are only loaded by the first wildcard query
+        self.terms = None
+        self.kgram_index = None
+
+    def expand(self, pattern, limit):
+        """
+        return up to limit terms of the segment that match a wildcard pattern, in alphabetical order (see wildcard.py)
+        """
+        if self.terms is None:
+            self.kgram_index = read_kgram_index(self.dict_file)
+            # the terms of a text dictionary are loaded in alphabetical order
+            self.terms = self.dictionary.terms() if isinstance(self.dictionary, BinaryDictionary) else list(self.dictionary)
+        return expand_wildcard(pattern, self.terms, self.kgram_index, limit)
+
+    def get_posting(self, entry):
+        """
+        return the decoded postings list of the dictionary entry of a term of the segment
+        """
+        # obtain the pointer to the posting
+        pointer, num_bytes, doc_freq, bitmap = entry
+        # obtain the corresponding posting pointed by the pointer, long postings lists as arrays if numpy is installed
+        return get_posting(self.postings_reader.read(pointer, num_bytes), self.postings_reader.binary, bitmap,
+                           self.postings_reader.blocked, is_long(doc_freq))
+
+    def close(self):
+        self.postings_reader.close()
+        if isinstance(self.dictionary, BinaryDictionary):
+            self.dictionary.close()
+
+
+def parse_shunting_yard(line, operators_prio, analyzer):
     """
     Stem the input query and parse it based on Reverse Polish notation.
     E.g. bill OR Gates -> bill gates OR
+    Wildcard terms are kept whole and lowercased instead of being tokenized and stemmed,
+    e.g. Comput* AND market -> comput* market AND
     https://www.youtube.com/watch?v=Jd71l0cHZL0
     """
+    tokens = []
+    position = 0
+    for match in WILDCARD_PATTERN.finditer(line):
+        tokens.extend(analyzer.split(line[position:match.start()]))
+        tokens.append(match.group())
+        position = match.end()
+    tokens.extend(analyzer.split(line[position:]))
+
     result = []
     op_stack = []
-    for token in nltk.word_tokenize(line):
-        if token not in operators_prio.keys():          # token is a word, move to result
-            stemmed_token = stemmer.stem(token)
+    for token in tokens:
+        if is_wildcard(token):                          # token is a wildcard term, move to result
+            result.append(token.lower())
+        elif token not in operators_prio.keys():        # token is a word, move to result
+            stemmed_token = analyzer.stem(token)
             result.append(stemmed_token)
         elif token == "(":                              # token is a left bracket, move to result
             op_stack.append(token)
         elif token == ")":                              # token is a right bracket, pop op_stack to result until left bracket is seen
+            if "(" not in op_stack:                     # no left bracket to match it
+                raise InvalidQueryError(token)
             operator = op_stack.pop()
             while operator != "(":
                 result.append(operator)
@@ -149,59 +800,425 @@ def parse_shunting_yard(line, operators_prio, stemmer):
     return result
 
 
-def and_op(p1, p2):
+class InvalidQueryError(Exception):
+    """
+    Raised when an operator in a query does not have enough operands, or a right bracket has no matching left bracket
+    """
+
+
+class QueryNode:
+    """
+    Node of a query operator tree. Leaves are "TERM" nodes holding a stemmed term, or "WILDCARD" nodes
+    holding a wildcard pattern and the terms it is expanded to, the other nodes hold an operator ("AND", "OR", "NOT")
+    and its operands
+    """
+    def __init__(self, op, children=None, term=None):
+        self.op = op
+        self.children = children if children is not None else []
+        self.term = term
+        self.terms = []          # the terms of a wildcard pattern, see Searcher.expand_wildcards
+        self.key = None          # hashable canonical form of the subexpression, see canonicalize
+        self.estimate = 0        # estimated number of docIDs in the result of this node
+
+
+def build_query_tree(shunting_yard_output):
+    """
+    Build the operator tree of a query in Reverse Polish notation.
+    Raises InvalidQueryError if an operator is missing operands, and
+    returns None if the query does not reduce to a single tree.
+    E.g. bill gates OR mac NOT AND -> AND(OR(bill, gates), NOT(mac))
+    """
+    node_stack = []
+    for token in shunting_yard_output:
+        if token == "AND" or token == "OR":
+            if len(node_stack) < 2:
+                raise InvalidQueryError(token)
+            right = node_stack.pop()
+            left = node_stack.pop()
+            node_stack.append(QueryNode(token, [left, right]))
+        elif token == "NOT":
+            if not node_stack:
+                raise InvalidQueryError(token)
+            node_stack.append(QueryNode(token, [node_stack.pop()]))
+        elif is_wildcard(token):
+            node_stack.append(QueryNode("WILDCARD", term=token))
+        else:
+            node_stack.append(QueryNode("TERM", term=token))
+
+    if len(node_stack) == 1:
+        return node_stack[0]
+    return None
+
+
+def canonicalize(node, negated=False):
+    """
+    Rewrite an operator tree into a canonical tree with the same result, in which every node has
+    a hashable key (op, term) or (op, keys of its operands), equal for all equivalent subexpressions:
+    - double NOTs cancel out, e.g. NOT NOT bill -> bill
+    - NOTs are pushed down to the terms with De Morgan's laws, e.g. NOT (a OR b) -> NOT a AND NOT b,
+      so that a AND NOT (b OR c) is evaluated as a minus b minus c
+    - chains of the same operator are flattened, repeated operands are dropped, e.g. xp AND xp -> xp,
+      and the operands of AND and OR are sorted by their keys
+    negated rewrites the NOT of the node instead
+    """
+    if node.op == "NOT":
+        return canonicalize(node.children[0], not negated)
+    if node.op == "TERM" or node.op == "WILDCARD":
+        leaf = QueryNode(node.op, term=node.term)
+        leaf.key = (node.op, node.term)
+        if not negated:
+            return leaf
+        negation = QueryNode("NOT", [leaf])
+        negation.key = ("NOT", leaf.key)
+        return negation
+
+    # NOT (a AND b) -> NOT a OR NOT b, NOT (a OR b) -> NOT a AND NOT b
+    op = node.op if not negated else ("OR" if node.op == "AND" else "AND")
+    operands = {}
+    for child in node.children:
+        child = canonicalize(child, negated)
+        for operand in (child.children if child.op == op else [child]):
+            operands[operand.key] = operand
+    if len(operands) == 1:
+        return next(iter(operands.values()))
+    keys = tuple(sorted(operands))
+    canonical = QueryNode(op, [operands[key] for key in keys])
+    canonical.key = (op, keys)
+    return canonical
+
+
+def plan_query(node, doc_freq, num_docs):
+    """
+    Rewrite the operator tree into a cheaper plan with the same result:
+    - chains of the same associative operator are flattened,
+      e.g. AND(AND(a, b), c) -> AND(a, b, c)
+    - the size of every node is estimated from the doc freq of its terms, given by doc_freq(term),
+      AND is at most its smallest operand, OR and wildcards are at most the sum of their operands
+    - AND operands are ordered from the smallest to the largest estimated size,
+      so that the intermediate results stay as small as possible
+    """
+    if node.op == "TERM":
+        node.estimate = doc_freq(node.term)
+        return node
+    if node.op == "WILDCARD":
+        node.estimate = min(sum(doc_freq(term) for term in node.terms), num_docs)
+        return node
+
+    children = [plan_query(child, doc_freq, num_docs) for child in node.children]
+    if node.op == "AND" or node.op == "OR":
+        flattened = []
+        for child in children:
+            if child.op == node.op:
+                flattened.extend(child.children)
+            else:
+                flattened.append(child)
+        children = flattened
+
+    if node.op == "AND":
+        children.sort(key=lambda child: child.estimate)
+        node.estimate = children[0].estimate
+    elif node.op == "OR":
+        node.estimate = min(sum(child.estimate for child in children), num_docs)
+    else:
+        node.estimate = num_docs - children[0].estimate
+    node.children = children
+    return node
+
+
+def evaluate_query(node, fetch_posting, all_postings, trace=None, results=None):
+    """
+    Evaluate a query plan and return the sorted matching docIDs, either as a list
+    or as a lazy Complement when the result is the NOT of a posting.
+    AND operands are evaluated in the planned order, and the evaluation stops
+    as soon as an operand is empty, e.g. japan AND sushi stops after sushi.
+    NOT operands of AND are never complemented: X AND NOT Y is computed as X minus Y.
+    With a QueryTrace, the operands and result of every operator are recorded.
+    With a SearchIndex as results, the result of every canonical subexpression is looked up by its key
+    in the result cache before it is evaluated, and cached once it is evaluated
+    """
+    if node.op == "TERM":
+        return fetch_posting(node.term)
+
+    if results is not None:
+        answer = results.cached_result(node.key)
+        if answer is not None:
+            if trace is not None:
+                trace.reused += 1
+            return answer
+
+    operands, answer = evaluate_operator(node, fetch_posting, all_postings, trace, results)
+    if trace is not None:
+        trace.record_operator(node.op, operands, answer)
+    if results is not None:
+        results.cache_result(node.key, answer)
+    return answer
+
+
+def evaluate_operator(node, fetch_posting, all_postings, trace=None, results=None):
+    """
+    Evaluate the operator of a node of a query plan, return its evaluated operands and its result
+    """
+    if node.op == "NOT":
+        operand = evaluate_query(node.children[0], fetch_posting, all_postings, trace, results)
+        return [operand], not_op(operand, all_postings)
+    # the postings of the terms of a wildcard are merged at once, see union
+    if node.op == "WILDCARD":
+        operands = [fetch_posting(term) for term in node.terms]
+        return operands, union(operands)
+
+    # split the operands into postings and complements of postings
+    operands = []
+    positives = []
+    negatives = []
+    for child in node.children:
+        operand = evaluate_query(child, fetch_posting, all_postings, trace, results)
+        operands.append(operand)
+        if isinstance(operand, Complement):
+            negatives.append(operand.posting)
+        elif node.op == "AND" and len(operand) == 0:
+            return operands, []
+        else:
+            positives.append(operand)
+
+    if node.op == "AND":
+        # NOT a AND NOT b -> NOT (a OR b)
+        if not positives:
+            return operands, not_op(union(negatives), all_postings)
+        # a AND b AND NOT c AND NOT d -> (a AND b) minus c minus d
+        answer = intersect(positives, trace)
+        for negative in negatives:
+            if len(answer) == 0:
+                break
+            answer = and_not_op(answer, negative)
+        return operands, answer
+
+    if not negatives:
+        return operands, union(positives)
+    # a OR NOT c OR NOT d -> NOT ((c AND d) minus a)
+    negative = intersect(negatives, trace)
+    if positives:
+        negative = and_not_op(negative, union(positives))
+    return operands, not_op(negative, all_postings)
+
+
+def iterate_query(node, fetch_posting, all_postings, results=None):
+    """
+    Lazily evaluate a query plan and yield its matching docIDs in increasing order.
+    Every operator only pulls the docIDs of its operands as far as it needs them, so the evaluation stops as soon as
+    the caller stops consuming docIDs, e.g. once a page of results is written, and lazy postings (BlockPostings,
+    Bitmap) are only decoded that far. NOT operands of AND are never complemented, like in evaluate_query.
+    The first operand of AND, the smallest of the plan, drives the intersection: every other operand that is the
+    posting of a term is probed for the docIDs it yields (see member_test) instead of being iterated, and so is every
+    negated posting of AND, so that blocks and runs of docIDs that cannot match are skipped, like in multi_and_op.
+    With a SearchIndex as results, a subexpression whose result is in the result cache is used like the posting of
+    a term instead of being evaluated, but the partial results of lazy operators are never cached
+    """
+    posting = query_posting(node, fetch_posting, results)
+    if posting is not None:
+        return iterate_posting(posting)
+    return iterate_operator(node, fetch_posting, all_postings, results)
+
+
+def iterate_operator(node, fetch_posting, all_postings, results=None):
+    """
+    Lazily evaluate an operator of a query plan whose result is not cached (see iterate_query)
+    """
+    if node.op == "WILDCARD":
+        return or_iter([iterate_posting(fetch_posting(term)) for term in node.terms])
+    if node.op == "NOT":
+        return complement_iter(node.children[0], fetch_posting, all_postings, results)
+
+    positives = [child for child in node.children if child.op != "NOT"]
+    negatives = [child.children[0] for child in node.children if child.op == "NOT"]
+
+    if node.op == "AND":
+        # NOT a AND NOT b -> (NOT a) minus b
+        if positives:
+            answer = iterate_query(positives[0], fetch_posting, all_postings, results)
+        else:
+            answer = complement_iter(negatives.pop(0), fetch_posting, all_postings, results)
+        for positive in positives[1:]:
+            answer = intersect_iter(answer, positive, fetch_posting, all_postings, results)
+        for negative in negatives:
+            answer = exclude_iter(answer, negative, fetch_posting, all_postings, results)
+        return answer
+    return or_iter([iterate_query(positive, fetch_posting, all_postings, results) for positive in positives]
+                   + [complement_iter(negative, fetch_posting, all_postings, results) for negative in negatives])
+
+
+def query_posting(node, fetch_posting, results=None):
+    """
+    return the posting of a TERM node or the cached result of any other node, or None if the node must be evaluated
+    """
+    if node.op == "TERM":
+        return fetch_posting(node.term)
+    if results is not None:
+        return results.cached_result(node.key)
+    return None
+
+
+def operand_iter(node, posting, fetch_posting, all_postings, results=None):
+    """
+    iterate over the posting of a node returned by query_posting, or evaluate the node lazily if it has none
+    """
+    if posting is not None:
+        return iterate_posting(posting)
+    return iterate_operator(node, fetch_posting, all_postings, results)
+
+
+def intersect_iter(docIDs, node, fetch_posting, all_postings, results=None):
+    """
+    Lazy AND of the sorted iterator docIDs with a node of a query plan (see iterate_query)
+    """
+    posting = query_posting(node, fetch_posting, results)
+    if posting is None or isinstance(posting, Complement):
+        operand = operand_iter(node, posting, fetch_posting, all_postings, results)
+        return and_iter([docIDs, operand])
+    return probe_iter(docIDs, posting)
+
+
+def complement_iter(node, fetch_posting, all_postings, results=None):
+    """
+    Lazy NOT of a node of a query plan: the docIDs of all_postings are merged with the docIDs of the node,
+    since probing the node for every docID would cost more, and the NOT of a Bitmap is its bitwise complement
+    """
+    posting = query_posting(node, fetch_posting, results)
+    if isinstance(posting, Bitmap):
+        return iterate_posting(Bitmap(all_postings.bits & ~posting.bits))
+    operand = operand_iter(node, posting, fetch_posting, all_postings, results)
+    return and_not_iter(iterate_posting(all_postings), operand)
+
+
+def exclude_iter(docIDs, node, fetch_posting, all_postings, results=None):
+    """
+    Lazy AND NOT of the sorted iterator docIDs with a node of a query plan (see iterate_query)
+    """
+    posting = query_posting(node, fetch_posting, results)
+    if posting is None or isinstance(posting, Complement):
+        operand = operand_iter(node, posting, fetch_posting, all_postings, results)
+        return and_not_iter(docIDs, operand)
+    return probe_iter(docIDs, posting, keep=False)
+
+
+def operand_size(operand):
+    """
+    return the number of docIDs of a posting, bitmap or Complement
+    """
+    if isinstance(operand, Complement):
+        return len(operand.all_postings) - sum(1 for docID in operand.posting if docID in operand.all_postings)
+    return len(operand)
+
+
+def intersect(postings, trace=None):
+    """
+    Intersect any number of posting lists and bitmaps with the cheapest available operator.
+    The bitmaps are intersected with each other first, then with the lists
+    """
+    bitmaps = [p for p in postings if isinstance(p, Bitmap)]
+    lists = [p for p in postings if not isinstance(p, Bitmap)]
+    if bitmaps:
+        bitmap = bitmaps[0]
+        for other in bitmaps[1:]:
+            bitmap = and_op(bitmap, other)
+        if not lists:
+            return bitmap
+        return and_op(intersect(lists, trace), bitmap)
+    if len(lists) == 1:
+        return lists[0]
+    if len(lists) == 2:
+        return and_op(lists[0], lists[1], trace)
+    if use_arrays(*lists):
+        return intersect_arrays(lists)
+    return multi_and_op(lists)
+
+
+def union(postings):
+    """
+    Union any number of posting lists and bitmaps with the cheapest available operator.
+    The lists are merged with each other first, then added to the bitmaps
+    """
+    bitmaps = [p for p in postings if isinstance(p, Bitmap)]
+    lists = [p for p in postings if not isinstance(p, Bitmap)]
+    if bitmaps:
+        bitmap = bitmaps[0]
+        for other in bitmaps[1:]:
+            bitmap = or_op(bitmap, other)
+        if not lists:
+            return bitmap
+        return or_op(union(lists), bitmap)
+    if len(lists) == 1:
+        return lists[0]
+    if len(lists) == 2:
+        return or_op(lists[0], lists[1])
+    if use_arrays(*lists):
+        return union_arrays(lists)
+    return multi_or_op(lists)
+
+
+def and_op(p1, p2, trace=None):
     """
     Intersect (AND operation) the left posting list and right posting list with skip pointers,
-    and return the a list of tuples (docID, skip pointer) where the docIDs intersect 
+    and return the list of docIDs that appear in both postings.
+    Skip pointers are evenly spaced, so the skip pointer of index i is i + skip_interval(len(p)),
+    and the skip pointers followed are counted in the QueryTrace, if any
+    If either posting is a Bitmap, the intersection is a bitwise AND or a membership test instead,
+    and if the longer posting is a BlockPostings, only its blocks that may hold the docIDs of the other are decoded.
+    Long postings are intersected as arrays instead (see vectorized.py)
     """
+    if isinstance(p1, Bitmap) and isinstance(p2, Bitmap):
+        return Bitmap(p1.bits & p2.bits)
+    if use_arrays(p1, p2):
+        return and_arrays(p1, p2)
+    if isinstance(p1, Bitmap):
+        return [docID for docID in p2 if docID in p1]
+    if isinstance(p2, Bitmap):
+        return [docID for docID in p1 if docID in p2]
+    # the shorter posting is probed in the blocks of the longer one, skipping the blocks that cannot match
+    if isinstance(p1, BlockPostings) or isinstance(p2, BlockPostings):
+        shorter, longer = sorted((p1, p2), key=len)
+        if isinstance(longer, BlockPostings):
+            return longer.intersect(shorter)
+        p1, p2 = list(p1), list(p2)
+
     answer = []
 
     # initiate the posting index
     p1_index = 0
     p2_index = 0
 
-    docID = 0
-    skip_pointer = 1
-    skip_pointer_gap = 16
+    p1_skip = skip_interval(len(p1))
+    p2_skip = skip_interval(len(p2))
 
     # compare the two postings until one of them reaches the end
     while (p1_index < len(p1)) and (p2_index < len(p2)):
-        p1_docID = p1[p1_index][docID]                      # docID of p1
-        p2_docID = p2[p2_index][docID]                      # docID of p2
-        p1_skip_pointer = p1[p1_index][skip_pointer]        # skip pointer of p1
-        p2_skip_pointer = p2[p2_index][skip_pointer]        # skip pointer of p2
+        p1_docID = p1[p1_index]                      # docID of p1
+        p2_docID = p2[p2_index]                      # docID of p2
 
         # if the docIDs match, that means we found an answer 
         if p1_docID == p2_docID:
-            answer.append(p1[p1_index])
+            answer.append(p1_docID)
             p1_index += 1
             p2_index += 1
 
         # if the docID(p1) is less than docID(p2), then check if p1 is skippable
         elif p1_docID < p2_docID:
-            # only use skip pointer if the length of the posting is >= than the skip pointer gap
-            if len(p1) >= skip_pointer_gap:
-                # if we are not at the end and the skip pointer is less than the docID,
-                # advance p1 index to be the skip pointer
-                while (p1_skip_pointer < len(p1)-1) and (p1[p1_skip_pointer][docID] <= p2_docID):
-                    p1_index = p1_skip_pointer
-                    p1_skip_pointer = p1[p1_index][skip_pointer]
-                else:
-                    p1_index += 1
+            # if p1 has skip pointers, follow them as long as they do not pass docID(p2),
+            # otherwise just advance p1 index by one
+            if p1_skip and p1_index + p1_skip < len(p1) and p1[p1_index + p1_skip] <= p2_docID:
+                while p1_index + p1_skip < len(p1) and p1[p1_index + p1_skip] <= p2_docID:
+                    p1_index += p1_skip
+                    if trace is not None:
+                        trace.skips += 1
             else:
                 p1_index += 1
 
         # if the docID(p2) is less than docID(p1), then check if p2 is skippable
         else:
-            # only use skip pointer if the length of the posting is >= than the skip pointer gap
-            if len(p2) >= skip_pointer_gap:
-                # if we are not at the end and the skip pointer is less than the docID,
-                # advance p2 index to be the skip pointer
-                while p2_skip_pointer < len(p2)-1 and (p2[p2_skip_pointer][docID] <= p1_docID):
-                    p2_index = p2[p2_index][skip_pointer]
-                    p2_skip_pointer = p2[p2_index][skip_pointer]
-                else:
-                    p2_index += 1
+            if p2_skip and p2_index + p2_skip < len(p2) and p2[p2_index + p2_skip] <= p1_docID:
+                while p2_index + p2_skip < len(p2) and p2[p2_index + p2_skip] <= p1_docID:
+                    p2_index += p2_skip
+                    if trace is not None:
+                        trace.skips += 1
             else:
                 p2_index += 1
 
@@ -211,34 +1228,43 @@ def and_op(p1, p2):
 def or_op(p1, p2):
     """
     Perform OR operation on the left posting list and the right posting list, and return
-    a list of tuples (docID, skip pointer) where the docID appears in any of the two postings 
+    the list of docIDs that appear in any of the two postings 
+    If either posting is a Bitmap, the result is a Bitmap from a bitwise OR.
+    Long postings are merged as arrays instead (see vectorized.py)
     """
+    if use_arrays(p1, p2):
+        return or_arrays(p1, p2)
+    if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+        p1_bits = p1.bits if isinstance(p1, Bitmap) else Bitmap.from_docIDs(p1).bits
+        p2_bits = p2.bits if isinstance(p2, Bitmap) else Bitmap.from_docIDs(p2).bits
+        return Bitmap(p1_bits | p2_bits)
+    # every docID is needed, so block postings are decoded whole
+    p1, p2 = materialize(p1), materialize(p2)
+
     answer = []
 
     # initiate the posting index
     p1_index = 0
     p2_index = 0
 
-    docID = 0
-
     while (p1_index < len(p1)) or (p2_index < len(p2)):
         # If both postings have not reached the end
         if (p1_index < len(p1)) and (p2_index < len(p2)):
-            p1_docID = p1[p1_index][docID]      # docID of p1
-            p2_docID = p2[p2_index][docID]      # docID of p2
+            p1_docID = p1[p1_index]      # docID of p1
+            p2_docID = p2[p2_index]      # docID of p2
 
             # if the docIDs match, that means we found an answer 
             if p1_docID == p2_docID:
-                answer.append(p1[p1_index])
+                answer.append(p1_docID)
                 p1_index += 1
                 p2_index += 1
             # if the docID(p1) is less than docID(p2)
             elif p1_docID < p2_docID:
-                answer.append(p1[p1_index])
+                answer.append(p1_docID)
                 p1_index += 1
             # if the docID(p2) is less than docID(p1)
             else:
-                answer.append(p2[p2_index])
+                answer.append(p2_docID)
                 p2_index += 1
 
         # if posting1 reached the end of its posting, add the docIDs in the rest of posting2
@@ -253,71 +1279,347 @@ def or_op(p1, p2):
 
     return answer
 
+def gallop(p, docID, start):
+    """
+    Return the index of the first docID in posting p, at or after index start, that is >= docID.
+    The search range doubles (exponential search) until it passes docID,
+    and is then narrowed down with a binary search
+    """
+    bound = 1
+    while start + bound < len(p) and p[start + bound] < docID:
+        bound *= 2
+    return bisect_left(p, docID, start + bound // 2, min(start + bound + 1, len(p)))
+
+
+def multi_and_op(postings):
+    """
+    Intersect (AND operation) any number of posting lists at once, and return
+    the list of docIDs that appear in all of them.
+    The shortest posting drives the intersection, and every other posting is
+    searched with gallop from where the previous docID was found, or for a BlockPostings,
+    its block is found from the block headers starting at the block where the previous docID was found
+    """
+    answer = []
+    postings = sorted(postings, key=len)
+    shortest = postings[0]
+    others = postings[1:]
+    others_index = [0] * len(others)
+
+    for docID in shortest:
+        for i, p in enumerate(others):
+            if isinstance(p, BlockPostings):
+                others_index[i] = p.seek(docID, others_index[i])
+                # if any posting reached the end, no further docID can be in all of them
+                if others_index[i] == p.num_blocks:
+                    return answer
+                if not p.block_contains(others_index[i], docID):
+                    break
+                continue
+            others_index[i] = gallop(p, docID, others_index[i])
+            # if any posting reached the end, no further docID can be in all of them
+            if others_index[i] == len(p):
+                return answer
+            if p[others_index[i]] != docID:
+                break
+        else:
+            answer.append(docID)
+
+    return answer
+
+
+def multi_or_op(postings):
+    """
+    Perform OR operation on any number of posting lists at once with a k-way heap merge,
+    and return the list of docIDs that appear in any of them
+    """
+    answer = []
+    for docID in merge(*postings):
+        if not answer or answer[-1] != docID:
+            answer.append(docID)
+    return answer
+
+
+class Complement:
+    """
+    Lazy result of a NOT operation: the docIDs of all_postings that are not in posting.
+    Nothing is materialized, iterating over it walks all_postings and posting once,
+    or computes the complement as an array at once if either is long (see vectorized.py).
+    all_postings is the Bitmap of all docIDs
+    """
+    def __init__(self, posting, all_postings):
+        self.posting = posting
+        self.all_postings = all_postings
+
+    def __sizeof__(self):
+        # all_postings is shared by every query
+        return postings_size(self.posting)
+
+    def __iter__(self):
+        if use_arrays(self.posting) or is_long(self.all_postings.bits.bit_length()):
+            yield from complement(self.posting, self.all_postings).tolist()
+            return
+        p = self.posting
+        p_index = 0
+        for docID in self.all_postings:
+            while p_index < len(p) and p[p_index] < docID:
+                p_index += 1
+            if p_index == len(p) or p[p_index] != docID:
+                yield docID
+
+
 def not_op(right_posting, all_postings):
     """
-    Perform NOT operation on the right posting and return a list of tuples (docID, skip pointer)
-    where the docID does not appear in the right posting
-    
+    Perform NOT operation on the right posting and return a lazy Complement of it.
+    The NOT of a Complement is the posting it complements, e.g. NOT NOT bill -> bill,
+    and the NOT of a Bitmap is its bitwise complement over the Bitmap of all docIDs
     """
+    if isinstance(right_posting, Complement):
+        return right_posting.posting
+    if isinstance(right_posting, Bitmap):
+        return Bitmap(all_postings.bits & ~right_posting.bits)
+    return Complement(materialize(right_posting), all_postings)
+
+
+def and_not_op(p1, p2):
+    """
+    Perform AND NOT operation on the left posting list and the right posting list, and return
+    the list of docIDs of p1 that do not appear in p2, without computing the NOT of p2.
+    Every docID of p1 is searched in p2 with gallop from where the previous docID was found.
+    If either posting is a Bitmap, the difference is a bitwise AND NOT or a membership test instead,
+    and if p2 is a BlockPostings, only its blocks that may hold the docIDs of p1 are decoded.
+    Long postings are subtracted as arrays instead (see vectorized.py)
+    """
+    if use_arrays(p1, p2):
+        return and_not_arrays(p1, p2)
+    if isinstance(p1, Bitmap):
+        p2_bits = p2.bits if isinstance(p2, Bitmap) else Bitmap.from_docIDs(p2).bits
+        return Bitmap(p1.bits & ~p2_bits)
+    if isinstance(p2, Bitmap):
+        return [docID for docID in p1 if docID not in p2]
+    if isinstance(p2, BlockPostings):
+        return p2.difference(p1)
+    p1 = materialize(p1)
+
     answer = []
-    p1 = get_posting(right_posting)
-    p1_index = 0
-    docID = 0
-    
-    # if p1 is empty, that means every posting is the result
-    if not p1:
-        return all_postings
-    else:
-        for posting in all_postings:
-            if posting[0] != p1[p1_index][docID]:
-                answer.append(posting)
-            elif p1_index + 1 < len(p1):
-                p1_index += 1
-        return answer
+    p2_index = 0
+
+    for p1_index, docID in enumerate(p1):
+        p2_index = gallop(p2, docID, p2_index)
+        # if p2 reached the end, the rest of p1 cannot be in p2
+        if p2_index == len(p2):
+            answer.extend(p1[p1_index:])
+            break
+        if p2[p2_index] != docID:
+            answer.append(docID)
+
+    return answer
+
+
+def materialize(posting):
+    """
+    return a BlockPostings as a list of all its docIDs, and any other posting as it is
+    """
+    if isinstance(posting, BlockPostings):
+        return list(posting)
+    return posting
 
 
-def get_posting(postings):
+def and_iter(iterators):
     """
-    Parse the postings into a list of tuples. Where the first item in the tuple is the docID, 
-    and the second item in the tuple is the skip pointer
-    e.g. (2,3) (3,10) (4,5) -> [(2, 3), (3, 10), (4, 5)]
+    Lazy AND: yield the docIDs that are in all the sorted iterators, in increasing order.
+    Every iterator is advanced up to the largest docID seen so far, so the first iterator,
+    the smallest operand of the plan, drives the intersection. Only used for operands that are subexpressions,
+    postings are probed instead (see probe_iter)
     """
-    if postings and type(postings) != list:
-        p = []
-        postings = "".join(postings.rstrip())
-        postings = postings.split(" ")
-        for posting in postings:
-            p.append(eval(posting))
-        return p
+    iterators = [iter(iterator) for iterator in iterators]
+    try:
+        docIDs = [next(iterator) for iterator in iterators]
+        while True:
+            target = max(docIDs)
+            for i, iterator in enumerate(iterators):
+                while docIDs[i] < target:
+                    docIDs[i] = next(iterator)
+            if docIDs.count(target) == len(docIDs):
+                yield target
+                docIDs[0] = next(iterators[0])
+    except StopIteration:
+        # once any iterator is exhausted, no further docID can be in all of them
+        return
+
+
+def or_iter(iterators):
+    """
+    Lazy OR: yield the docIDs of any of the sorted iterators once, in increasing order, with a k-way heap merge
+    """
+    previous = None
+    for docID in merge(*iterators):
+        if docID != previous:
+            yield docID
+            previous = docID
+
+
+def and_not_iter(docIDs, negative):
+    """
+    Lazy AND NOT: yield the docIDs of the sorted iterator docIDs that are not in the sorted iterator negative,
+    advancing negative only up to the docID being checked
+    """
+    negative = iter(negative)
+    excluded = next(negative, None)
+    for docID in docIDs:
+        while excluded is not None and excluded < docID:
+            excluded = next(negative, None)
+        if excluded != docID:
+            yield docID
+
+
+def probe_iter(docIDs, posting, keep=True):
+    """
+    Yield the docIDs of the sorted iterator docIDs that are in a posting, or with keep False that are not in it,
+    probing the posting for every docID (see member_test). An array is probed PROBE_CHUNK docIDs at a time
+    with a single binary search of the whole chunk (see vectorized.py)
+    """
+    if is_array(posting):
+        docIDs = iter(docIDs)
+        while chunk := list(islice(docIDs, PROBE_CHUNK)):
+            members = member_mask(as_array(chunk), posting)
+            yield from compress(chunk, (members if keep else ~members).tolist())
+        return
+    contains = member_test(posting)
+    for docID in docIDs:
+        if contains(docID) == keep:
+            yield docID
+
+
+def member_test(posting):
+    """
+    return a function telling whether a docID is in a posting, for docIDs asked in increasing order:
+    a bit test for a Bitmap, a search of the block headers from the block of the previous docID then of a single block
+    for a BlockPostings, and a gallop from the position of the previous docID for a list
+    """
+    if isinstance(posting, Bitmap):
+        return posting.__contains__
+    position = 0
+    if isinstance(posting, BlockPostings):
+        def contains(docID):
+            nonlocal position
+            position = posting.seek(docID, position)
+            return position < posting.num_blocks and posting.block_contains(position, docID)
+        return contains
+
+    def contains(docID):
+        nonlocal position
+        # a driver denser than the list mostly asks for docIDs up to the current position, which need no search
+        if position < len(posting) and posting[position] < docID:
+            position = gallop(posting, docID, position)
+        return position < len(posting) and posting[position] == docID
+    return contains
+
+
+def iterate_posting(posting):
+    """
+    yield the docIDs of a posting, bitmap, Complement or array in increasing order.
+    An array is converted to python ints OUTPUT_CHUNK docIDs at a time
+    """
+    if is_array(posting):
+        for start in range(0, len(posting), OUTPUT_CHUNK):
+            yield from posting[start:start + OUTPUT_CHUNK].tolist()
     else:
-        return postings
+        yield from posting
+
+
+def write_docIDs(docIDs, out):
+    """
+    Write the docIDs of an iterator separated by spaces and followed by a new line to out, formatting OUTPUT_CHUNK
+    docIDs at a time, so that neither the docIDs nor the output of a long result are ever held in memory at once
+    """
+    docIDs = iter(docIDs)
+    separator = ""
+    while True:
+        chunk = " ".join(map(str, islice(docIDs, OUTPUT_CHUNK)))
+        if not chunk:
+            break
+        out.write(separator)
+        out.write(chunk)
+        separator = " "
+    out.write("\n")
+
+
+def get_posting(postings, binary, bitmap=False, blocked=False, vectorize=False):
+    """
+    Decode the bytes of a postings list, e.g. a slice of the PostingsReader, into a list of docIDs,
+    or into a Bitmap if the dictionary marks the term as stored in the bitmap representation.
+    Blocked binary postings of more than one block are only decoded a block at a time when needed (see BlockPostings).
+    With vectorize, the postings list is decoded whole into a numpy array instead (see vectorized.py).
+    Binary postings are variable byte encoded gaps between docIDs,
+    e.g. 10000010 10000001 10000111 -> gaps [2, 1, 7] -> [2, 3, 10]
+    Text postings are (docID, skip pointer) tuples, e.g. (2,3) (3,10) (10,5) -> [2, 3, 10]
+    """
+    if bitmap:
+        return decode_bitmap(postings)
+    if vectorize:
+        return decode_postings_array(postings, blocked) if binary else as_array(decode_text_postings(postings))
+    if blocked:
+        return read_block_postings(postings)
+    if binary:
+        return decode_postings(postings)
+    return decode_text_postings(postings)
             
 
-file_of_output = "/home/e/e1100368/CS3245/CS3245/HW2/output.txt"
-file_of_queries = "/home/e/e1100368/CS3245/CS3245/HW2/queries.txt"
-postings_file = "/home/e/e1100368/CS3245/CS3245/HW2/postings.txt"
-dictionary_file = "/home/e/e1100368/CS3245/CS3245/HW2/dictionary.txt"
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-d':
-        dictionary_file  = a
-    elif o == '-p':
-        postings_file = a
-    elif o == '-q':
-        file_of_queries = a
-    elif o == '-o':
-        file_of_output = a
-    else:
-        assert False, "unhandled option"
+if __name__ == "__main__":
+    file_of_output = "/home/e/e1100368/CS3245/CS3245/HW2/output.txt"
+    file_of_queries = "/home/e/e1100368/CS3245/CS3245/HW2/queries.txt"
+    postings_file = "/home/e/e1100368/CS3245/CS3245/HW2/postings.txt"
+    dictionary_file = "/home/e/e1100368/CS3245/CS3245/HW2/dictionary.txt"
+    postings_cache_size = 32
+    server_port = None
+    trace = False
+    num_workers = 1
+    max_expansions = MAX_EXPANSIONS
+    result_cache_size = 16
+    limit = None
+    offset = 0
 
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None :
-    usage()
-    sys.exit(2)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:c:S:tj:w:r:n:s:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file  = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-c':
+            postings_cache_size = float(a)
+        elif o == '-S':
+            server_port = int(a)
+        elif o == '-t':
+            trace = True
+        elif o == '-j':
+            num_workers = int(a)
+        elif o == '-w':
+            max_expansions = int(a)
+        elif o == '-r':
+            result_cache_size = float(a)
+        elif o == '-n':
+            limit = int(a)
+        elif o == '-s':
+            offset = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None :
+        usage()
+        sys.exit(2)
+
+    if server_port is not None:
+        serve_search(dictionary_file, postings_file, server_port, postings_cache_size, max_expansions, result_cache_size,
+                     limit, offset)
+    else:
+        run_search(dictionary_file, postings_file, file_of_queries, file_of_output, postings_cache_size, trace, num_workers,
+                   max_expansions, result_cache_size, limit, offset)
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+import getopt
+import json
+import sys
+import time
+
+from urllib.request import Request, urlopen
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -S port -q file-of-queries -o output-file-of-results -t (optional flag to print the server stats)")
+
+def run_client(port, queries_file, results_file, print_stats=False):
+    """
+    send the queries file to a search server started with search.py -S port,
+    and write its results to the results file, exactly as run_search would
+    """
+    with open(queries_file, "rb") as file:
+        queries = file.read()
+    start_time = time.perf_counter()
+    request = Request(f"http://127.0.0.1:{port}/search", data=queries, headers={"Content-Type": "text/plain; charset=utf-8"})
+    with urlopen(request) as response:
+        results = response.read()
+    print(f"searched in {time.perf_counter() - start_time:.3f}s")
+    with open(results_file, "wb") as result_f:
+        result_f.write(results)
+
+    if print_stats:
+        with urlopen(f"http://127.0.0.1:{port}/stats") as response:
+            print(json.dumps(json.load(response), indent=2))
+
+
+server_port = None
+file_of_queries = None
+file_of_output = None
+print_stats = False
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'S:q:o:t')
+except getopt.GetoptError:
+    usage()
+    sys.exit(2)
+
+for o, a in opts:
+    if o == '-S':
+        server_port = int(a)
+    elif o == '-q':
+        file_of_queries = a
+    elif o == '-o':
+        file_of_output = a
+    elif o == '-t':
+        print_stats = True
+    else:
+        assert False, "unhandled option"
+
+if server_port == None or file_of_queries == None or file_of_output == None:
+    usage()
+    sys.exit(2)
+
+run_client(server_port, file_of_queries, file_of_output, print_stats)
@@ -0,0 +1,138 @@
+'''
+Segments of an incrementally built index, shared by index.py and search.py
+
+A full build writes a single dictionary and postings file pair. Documents added later are indexed into
+new immutable segments, each with its own dictionary and postings file (dictionary-file.N and postings-file.N),
+and the first line of every segment's dictionary holds the docIDs of that segment only.
+The segments are listed in the manifest (dictionary-file.segments):
+    the first line is the next segment number, every other line is "segment-number number-of-docs".
+    Segment 0 is the dictionary and postings file pair of the full build.
+Deleted docIDs are kept in a tombstone bitmap (dictionary-file.deleted) and removed from every search result.
+Without a manifest, the index is the single dictionary and postings file pair.
+'''
+import fcntl
+import os
+
+from contextlib import contextmanager
+from math import floor, log
+
+from bitmap import Bitmap, decode_bitmap, encode_bitmap
+
+MERGE_FACTOR = 4            # number of segments of the same tier that are merged into one segment of the next tier
+
+
+def manifest_file(dict_file):
+    return f"{dict_file}.segments"
+
+def tombstone_file(dict_file):
+    return f"{dict_file}.deleted"
+
+def segment_files(dict_file, postings_file, segment_number):
+    '''
+    return the dictionary and postings file of a segment
+    '''
+    if segment_number == 0:
+        return dict_file, postings_file
+    return f"{dict_file}.{segment_number}", f"{postings_file}.{segment_number}"
+
+@contextmanager
+def manifest_lock(dict_file):
+    '''
+    hold an exclusive lock on the manifest while it is read and rewritten
+    '''
+    with open(f"{manifest_file(dict_file)}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@contextmanager
+def merge_lock(dict_file):
+    '''
+    try to become the only process merging the segments of the index, and yield whether it succeeded
+    '''
+    with open(f"{manifest_file(dict_file)}.merging", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_manifest(dict_file):
+    '''
+    return the next segment number and the list of (segment number, number of docs) of the index,
+    or None if the index has no manifest
+    '''
+    if not os.path.exists(manifest_file(dict_file)):
+        return None
+    with open(manifest_file(dict_file), "r") as manifest:
+        next_segment_number = int(manifest.readline())
+        segments = [tuple(int(x) for x in line.split()) for line in manifest]
+    return next_segment_number, segments
+
+def write_manifest(dict_file, next_segment_number, segments):
+    '''
+    replace the manifest in one atomic rename, so that searches never read a partial manifest
+    '''
+    temp_file = f"{manifest_file(dict_file)}.tmp"
+    with open(temp_file, "w") as manifest:
+        manifest.write(f"{next_segment_number}\n")
+        for segment_number, num_docs in segments:
+            manifest.write(f"{segment_number} {num_docs}\n")
+    os.replace(temp_file, manifest_file(dict_file))
+
+def list_segments(dict_file, postings_file):
+    '''
+    return the (dictionary file, postings file) of every segment of the index
+    '''
+    manifest = read_manifest(dict_file)
+    if manifest is None:
+        return [(dict_file, postings_file)]
+    return [segment_files(dict_file, postings_file, segment_number) for segment_number, _ in manifest[1]]
+
+def read_tombstones(dict_file):
+    '''
+    return the Bitmap of deleted docIDs
+    '''
+    if not os.path.exists(tombstone_file(dict_file)):
+        return Bitmap()
+    with open(tombstone_file(dict_file), "rb") as tombstones:
+        return decode_bitmap(tombstones.read())
+
+def add_tombstones(dict_file, doc_ids):
+    '''
+    add the given docIDs to the tombstone bitmap
+    '''
+    with manifest_lock(dict_file):
+        tombstones = read_tombstones(dict_file)
+        tombstones = Bitmap(tombstones.bits | Bitmap.from_docIDs(sorted(doc_ids)).bits)
+        temp_file = f"{tombstone_file(dict_file)}.tmp"
+        with open(temp_file, "wb") as tombstones_file:
+            tombstones_file.write(encode_bitmap(list(tombstones)))
+        os.replace(temp_file, tombstone_file(dict_file))
+
+def segment_tier(num_docs):
+    '''
+    segments of up to MERGE_FACTOR docs are in tier 0, up to MERGE_FACTOR**2 docs in tier 1, ...
+    '''
+    return floor(log(max(num_docs, 1), MERGE_FACTOR))
+
+def select_merge(segments):
+    '''
+    Tiered merge policy: return the segment numbers of MERGE_FACTOR segments of the lowest tier
+    that has at least MERGE_FACTOR segments, or an empty list if no merge is needed.
+    Merging segments of similar sizes keeps the number of segments logarithmic in the number of docs,
+    while every docID is rewritten only once per tier.
+    '''
+    tiers = {}
+    for segment_number, num_docs in segments:
+        tiers.setdefault(segment_tier(num_docs), []).append(segment_number)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= MERGE_FACTOR:
+            return tiers[tier][:MERGE_FACTOR]
+    return []
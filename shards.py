@@ -0,0 +1,67 @@
+'''
+Document-range shards of an index, shared by index.py and search.py
+
+index.py -s N partitions the collection by docID range into N shards of about the same number of documents.
+Every shard is an independent index with its own dictionary and postings file (dictionary-file.shardK and
+postings-file.shardK), whose first line holds the docIDs of that shard only, and its own k-gram index, tokenizer,
+segments and tombstones (see segments.py), so that it can be searched on its own, e.g. by a different machine.
+The shards are listed in the shard manifest (dictionary-file.shards), one line per shard in shard order,
+holding the first docID of its range: shard K holds the docIDs from its first docID up to the first docID of shard K+1,
+and the first docID of shard 0 is always 0.
+Without a shard manifest, the index is a single shard made of the dictionary and postings file pair.
+'''
+import os
+
+from bisect import bisect_left
+
+
+def shard_manifest_file(dict_file):
+    return f"{dict_file}.shards"
+
+def shard_files(dict_file, postings_file, shard_number):
+    '''
+    return the dictionary and postings file of a shard
+    '''
+    return f"{dict_file}.shard{shard_number}", f"{postings_file}.shard{shard_number}"
+
+def read_shard_manifest(dict_file):
+    '''
+    return the first docID of every shard of the index, in shard order, or None if the index is not sharded
+    '''
+    if not os.path.exists(shard_manifest_file(dict_file)):
+        return None
+    with open(shard_manifest_file(dict_file), "r") as manifest:
+        return [int(line) for line in manifest]
+
+def write_shard_manifest(dict_file, first_doc_ids):
+    '''
+    replace the shard manifest in one atomic rename, so that searches never read a partial manifest
+    '''
+    temp_file = f"{shard_manifest_file(dict_file)}.tmp"
+    with open(temp_file, "w") as manifest:
+        manifest.writelines(f"{first_doc_id}\n" for first_doc_id in first_doc_ids)
+    os.replace(temp_file, shard_manifest_file(dict_file))
+
+def list_shards(dict_file, postings_file):
+    '''
+    return the (dictionary file, postings file) of every shard of the index, in docID order
+    '''
+    first_doc_ids = read_shard_manifest(dict_file)
+    if first_doc_ids is None:
+        return [(dict_file, postings_file)]
+    return [shard_files(dict_file, postings_file, shard_number) for shard_number in range(len(first_doc_ids))]
+
+def shard_ranges(doc_ids, num_shards):
+    '''
+    return the first docIDs of num_shards ranges holding about the same number of the sorted docIDs,
+    with fewer shards if there are fewer docIDs than shards
+    '''
+    num_shards = max(min(num_shards, len(doc_ids)), 1)
+    return [0] + [doc_ids[shard * len(doc_ids) // num_shards] for shard in range(1, num_shards)]
+
+def split_by_shard(doc_ids, first_doc_ids):
+    '''
+    split sorted docIDs into the sorted docIDs of every shard, given the first docID of every shard
+    '''
+    cuts = [0] + [bisect_left(doc_ids, first_doc_id) for first_doc_id in first_doc_ids[1:]] + [len(doc_ids)]
+    return [doc_ids[start:stop] for start, stop in zip(cuts, cuts[1:])]
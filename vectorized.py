@@ -0,0 +1,184 @@
+'''
+Optional NumPy backend for long postings lists, used by search.py when numpy is installed
+
+Postings lists of at least NUMPY_THRESHOLD docIDs are decoded straight into sorted uint32 arrays,
+with the variable byte decoding and the prefix sum of the gaps done on the whole list at once,
+and the operators of search.py switch to the kernels below as soon as one of their operands is an array
+or their lists add up to NUMPY_THRESHOLD docIDs:
+    - AND: the docIDs of the shorter list are binary searched in the longer one all at once (searchsorted)
+    - OR: the lists are concatenated and merged by a stable sort, which merges sorted runs, then deduplicated
+    - AND NOT and NOT: a boolean mask over the docID universe, cleared at the docIDs to remove
+A Bitmap operand is unpacked into a boolean mask over the docID universe.
+The results hold the same sorted docIDs as the pure python operators, in arrays instead of lists.
+Without numpy, use_arrays is always False and search.py only uses the pure python operators.
+'''
+from bitmap import Bitmap
+from postings import POSTINGS_BLOCK_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_THRESHOLD = 4096          # docIDs from which a postings list is decoded into, and operated on as, an array
+
+
+def is_array(posting):
+    return numpy is not None and isinstance(posting, numpy.ndarray)
+
+def is_long(num_doc_ids):
+    '''
+    return whether numpy is installed and num_doc_ids docIDs are enough to be operated on as an array
+    '''
+    return numpy is not None and num_doc_ids >= NUMPY_THRESHOLD
+
+def use_arrays(*postings):
+    '''
+    return whether the postings are operated on as arrays: when numpy is installed and
+    either one of them is an array already, or their lists hold at least NUMPY_THRESHOLD docIDs together
+    '''
+    if numpy is None:
+        return False
+    if any(isinstance(posting, numpy.ndarray) for posting in postings):
+        return True
+    return is_long(sum(len(posting) for posting in postings if not isinstance(posting, Bitmap)))
+
+def decode_vbyte_array(data):
+    '''
+    Decode a buffer of variable byte encoded integers into an array of integers, e.g.
+    bytes    00000110 10111000 10000101
+    ends               ^        ^
+    shifts   7        0        0
+    numbers  (6 << 7 | 56) = 824, 5
+    '''
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data >= 128)           # the last byte of every number has its high bit set
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    # every byte holds the 7 bits of its number that are 7 times its distance to the last byte up
+    shifts = (numpy.repeat(ends, ends - starts + 1) - numpy.arange(len(data))) * 7
+    values = (data & 0x7f).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+    return numpy.add.reduceat(values, starts) if len(ends) else values
+
+def decode_postings_array(data, blocked=True):
+    '''
+    Decode a binary postings list, blocked or not, into a sorted uint32 array of docIDs. The gaps of the blocked format
+    start from the last docID of the previous block, so its blocks are a single run of gaps after the headers
+    '''
+    numbers = decode_vbyte_array(data)
+    if blocked and len(numbers):
+        num_blocks = -(-int(numbers[0]) // POSTINGS_BLOCK_SIZE)
+        numbers = numbers[1 + 2 * num_blocks:]
+    return numpy.cumsum(numbers).astype(numpy.uint32)
+
+def as_array(posting):
+    '''
+    return the docIDs of a list, BlockPostings, Bitmap or array as a sorted uint32 array
+    '''
+    if isinstance(posting, numpy.ndarray):
+        return posting
+    if isinstance(posting, Bitmap):
+        return numpy.flatnonzero(bitmap_mask(posting)).astype(numpy.uint32)
+    return numpy.array(posting if isinstance(posting, list) else list(posting), dtype=numpy.uint32)
+
+def bitmap_mask(bitmap):
+    '''
+    return a Bitmap as a boolean mask over the docIDs up to its last one
+    '''
+    bits = numpy.unpackbits(numpy.frombuffer(bitmap.to_bytes(), dtype=numpy.uint8), bitorder='little')
+    return bits.view(numpy.bool_)
+
+def to_bitmap(doc_ids):
+    '''
+    return a Bitmap of an array of docIDs
+    '''
+    if len(doc_ids) == 0:
+        return Bitmap()
+    mask = numpy.zeros(int(doc_ids[-1]) + 1, dtype=numpy.bool_)
+    mask[doc_ids] = True
+    return Bitmap(int.from_bytes(numpy.packbits(mask, bitorder='little').tobytes(), 'little'))
+
+def member_mask(doc_ids, posting):
+    '''
+    return a boolean array telling which docIDs of a sorted array are in a posting:
+    the bits of a Bitmap are looked up directly, and any other posting is binary searched all at once
+    '''
+    if isinstance(posting, Bitmap):
+        mask = bitmap_mask(posting)
+        inside = doc_ids < len(mask)
+        members = numpy.zeros(len(doc_ids), dtype=numpy.bool_)
+        members[inside] = mask[doc_ids[inside]]
+        return members
+    posting = as_array(posting)
+    if len(posting) == 0:
+        return numpy.zeros(len(doc_ids), dtype=numpy.bool_)
+    positions = numpy.searchsorted(posting, doc_ids)
+    return posting[numpy.minimum(positions, len(posting) - 1)] == doc_ids
+
+def and_arrays(p1, p2):
+    '''
+    Intersect two postings, at least one of which is not a Bitmap, into an array.
+    The docIDs of the shorter list are searched in the longer one
+    '''
+    if isinstance(p1, Bitmap) or (not isinstance(p2, Bitmap) and len(p2) < len(p1)):
+        p1, p2 = p2, p1
+    p1 = as_array(p1)
+    return p1[member_mask(p1, p2)]
+
+def or_arrays(p1, p2):
+    '''
+    Union two postings into an array, or into a Bitmap if either of them is a Bitmap
+    '''
+    if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+        p1_bits = p1.bits if isinstance(p1, Bitmap) else to_bitmap(as_array(p1)).bits
+        p2_bits = p2.bits if isinstance(p2, Bitmap) else to_bitmap(as_array(p2)).bits
+        return Bitmap(p1_bits | p2_bits)
+    return union_arrays([p1, p2])
+
+def and_not_arrays(p1, p2):
+    '''
+    return the docIDs of p1 that are not in p2, as an array, or as a Bitmap if p1 is a Bitmap.
+    The docIDs of p2 are cleared from a mask of the docIDs of p1
+    '''
+    if isinstance(p1, Bitmap):
+        p2_bits = p2.bits if isinstance(p2, Bitmap) else to_bitmap(as_array(p2)).bits
+        return Bitmap(p1.bits & ~p2_bits)
+    p1 = as_array(p1)
+    if len(p1) == 0:
+        return p1
+    mask = numpy.zeros(int(p1[-1]) + 1, dtype=numpy.bool_)
+    mask[p1] = True
+    p2 = as_array(p2)
+    mask[p2[p2 < len(mask)]] = False
+    return numpy.flatnonzero(mask).astype(numpy.uint32)
+
+def complement(posting, universe):
+    '''
+    return the docIDs of the Bitmap universe that are not in posting, as an array
+    '''
+    mask = bitmap_mask(universe).copy()
+    posting = as_array(posting)
+    mask[posting[posting < len(mask)]] = False
+    return numpy.flatnonzero(mask).astype(numpy.uint32)
+
+def intersect_arrays(postings):
+    '''
+    Intersect any number of postings, none of which is a Bitmap, from the shortest to the longest
+    '''
+    postings = sorted(postings, key=len)
+    answer = as_array(postings[0])
+    for posting in postings[1:]:
+        if len(answer) == 0:
+            break
+        answer = answer[member_mask(answer, posting)]
+    return answer
+
+def union_arrays(postings):
+    '''
+    Union any number of postings, none of which is a Bitmap, with a single merge of all their docIDs
+    '''
+    if not postings:
+        return numpy.zeros(0, dtype=numpy.uint32)
+    merged = numpy.sort(numpy.concatenate([as_array(posting) for posting in postings]), kind='stable')
+    if len(merged) == 0:
+        return merged
+    return merged[numpy.concatenate(([True], merged[1:] != merged[:-1]))]
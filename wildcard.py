@@ -0,0 +1,140 @@
+'''
+Wildcard terms, e.g. comput* or *ing or b*ll, shared by index.py and search.py
+
+A wildcard term is matched against the terms of the dictionary, which are stemmed, so the pattern is only
+lowercased and never stemmed itself. Its terms are found in the sorted term array of the dictionary:
+    - the terms that start with the part of the pattern before its first * are a contiguous range
+      of the sorted term array, found with two binary searches
+    - for the other parts, index.py writes a k-gram index next to every dictionary (dictionary-file.kgrams):
+      every line is a k-gram of the terms padded with $, e.g. $co com omp mpu put ut$ for comput,
+      followed by the indexes of the terms that contain it in the sorted term array.
+      The candidates of a pattern are the terms that contain all the k-grams of its parts.
+The smaller of the two candidate sets is then checked against the whole pattern,
+since the k-grams of a term can match the pattern in a different order.
+'''
+import os
+import re
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+KGRAM_SIZE = 3
+MAX_EXPANSIONS = 1024           # number of terms a wildcard term is expanded to at most
+WILDCARD_PATTERN = re.compile(r"[^\s()]*\*[^\s()]*")
+
+
+def kgram_file(dict_file):
+    return f"{dict_file}.kgrams"
+
+def kgrams(term):
+    '''
+    return the set of k-grams of a term padded with $, e.g. ut -> {$ut, ut$}
+    '''
+    padded = f"${term}$"
+    return {padded[start:start + KGRAM_SIZE] for start in range(len(padded) - KGRAM_SIZE + 1)}
+
+def pattern_kgrams(pattern):
+    '''
+    return the set of k-grams that every term matching the pattern contains, e.g. com*ing -> {$co, com, ing, ng$}.
+    Only the parts around the * that are at least KGRAM_SIZE long (with the $ padding) have any
+    '''
+    grams = set()
+    for part in f"${pattern}$".split("*"):
+        grams.update(part[start:start + KGRAM_SIZE] for start in range(len(part) - KGRAM_SIZE + 1))
+    return grams
+
+def is_wildcard(token):
+    return "*" in token and token.strip("*") != ""
+
+def wildcard_matcher(pattern):
+    '''
+    return a function telling whether a whole term matches the pattern, where * matches any characters
+    '''
+    return re.compile(".*".join(re.escape(part) for part in pattern.split("*")), re.DOTALL).fullmatch
+
+
+class KGramIndexWriter:
+    '''
+    Collects the k-grams of the terms of a dictionary, added in alphabetical order,
+    and writes the k-gram index of the dictionary when closed
+    '''
+    def __init__(self, dict_file):
+        '''
+        Constructor
+        '''
+        self.kgram_file = kgram_file(dict_file)
+        self.index = defaultdict(lambda: array('I'))
+        self.num_terms = 0
+
+    def add(self, term):
+        # terms are added in order, so the term indexes of every k-gram are sorted
+        for gram in kgrams(term):
+            self.index[gram].append(self.num_terms)
+        self.num_terms += 1
+
+    def close(self):
+        with open(self.kgram_file, "w") as file:
+            for gram in sorted(self.index):
+                file.write(gram + " " + " ".join(map(str, self.index[gram])) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_kgram_index(dict_file):
+    '''
+    return the k-gram index of a dictionary file as a dict of k-gram -> sorted array of term indexes,
+    or None if the index was built without one
+    '''
+    if not os.path.exists(kgram_file(dict_file)):
+        return None
+    kgram_index = {}
+    with open(kgram_file(dict_file), "r") as file:
+        for line in file:
+            gram, *term_indexes = line.split()
+            kgram_index[gram] = array('I', map(int, term_indexes))
+    return kgram_index
+
+def prefix_range(terms, prefix):
+    '''
+    return the (start, stop) range of the terms of a sorted term array that start with prefix
+    '''
+    if not prefix:
+        return 0, len(terms)
+    start = bisect_left(terms, prefix)
+    # the first term after all the terms starting with prefix
+    stop = bisect_left(terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+    return start, stop
+
+def contains(sorted_array, item):
+    position = bisect_left(sorted_array, item)
+    return position < len(sorted_array) and sorted_array[position] == item
+
+def expand_wildcard(pattern, terms, kgram_index=None, limit=MAX_EXPANSIONS):
+    '''
+    return up to limit terms of a sorted term array that match the wildcard pattern, in alphabetical order.
+    The candidates are either the range of terms starting with the prefix of the pattern,
+    or the terms with all the k-grams of the pattern, whichever is smaller
+    '''
+    start, stop = prefix_range(terms, pattern.split("*", 1)[0])
+    candidates = range(start, stop)
+    grams = pattern_kgrams(pattern)
+    if kgram_index is not None and grams:
+        gram_lists = sorted((kgram_index.get(gram, array('I')) for gram in grams), key=len)
+        if len(gram_lists[0]) < len(candidates):
+            candidates = (term_index for term_index in gram_lists[0]
+                          if start <= term_index < stop and all(contains(other, term_index) for other in gram_lists[1:]))
+
+    matches = wildcard_matcher(pattern)
+    expanded = []
+    for term_index in candidates:
+        term = terms[term_index]
+        if matches(term):
+            expanded.append(term)
+            if len(expanded) == limit:
+                break
+    return expanded